@@ -0,0 +1,551 @@
+# Offline benchmark for bot.py: drives the command coroutines through a fake
+# Discord context and a fake Gemini client, so no bot token or API key is needed.
+#
+#   python benchmark.py --commands ask,describe --requests 200 --concurrency 50
+#
+# For every command it reports requests/sec, event-loop lag, the memory
+# high-water mark, bytes sent to Gemini and the per-stage latency percentiles
+# recorded by bot.py's timing spans.
+import argparse
+import array
+import asyncio
+import io
+import math
+import os
+import random
+import re
+import tempfile
+import time
+import tracemalloc
+import types as pytypes
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+# bot.py reads its configuration at import time; keep its state out of the
+# working directory and take the real rate limits out of the measurement.
+STATE_DIR = tempfile.mkdtemp(prefix="bot_benchmark_")
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("UPLOAD_CACHE_PATH", os.path.join(STATE_DIR, "upload_cache.sqlite3"))
+os.environ.setdefault("JOBS_PATH", os.path.join(STATE_DIR, "jobs.sqlite3"))
+os.environ.setdefault("LOG_FILE", "")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("GEMINI_MODEL_RPM", "1000000000")
+os.environ.setdefault("GEMINI_KEY_RPM", "1000000000")
+os.environ.setdefault("FILE_POLL_MIN", "0.05")
+os.environ.setdefault("FILE_POLL_MAX", "0.5")
+
+from google.genai import errors
+from google.genai import models
+from google.genai import types
+from google.genai.chats import Chat
+from PIL import Image
+
+import bot
+
+
+# Fake Discord objects
+
+# How the commands' answers start (status messages like "Thinking..." do not)
+ANSWER_PREFIXES = ("**Answer", "**Response", "**Description", "**Summary", "<@")
+
+
+class FakeMessage:
+    def __init__(self, channel, content, **kwargs):
+        self.channel = channel
+        self.content = content
+        self.attachments = kwargs.get("attachments", [])
+        self.edits = 0
+        channel.shown(content)
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        self.content = content
+        self.channel.shown(content)
+        self.edits += 1
+        self.channel.edits += 1
+        return self
+
+    async def delete(self):
+        await asyncio.sleep(self.channel.latency)
+        self.channel.sent.remove(self)
+
+
+class FakeContext:
+    def __init__(self, command, attachments=(), latency=0.02, guild=1, user=1):
+        self.command = pytypes.SimpleNamespace(name=command)
+        self.guild = pytypes.SimpleNamespace(id=guild)
+        self.channel = pytypes.SimpleNamespace(id=guild * 1000 + user, send=self.send)
+        self.author = pytypes.SimpleNamespace(id=user)
+        self.message = pytypes.SimpleNamespace(attachments=list(attachments))
+        self.interaction = None
+        self.latency = latency
+        self.sent = []
+        self.edits = 0
+        self.started = None  # when the command was invoked
+        self.answered = None  # when the first part of the answer was visible
+
+    def shown(self, content):
+        if self.answered is None and (content or "").startswith(ANSWER_PREFIXES):
+            self.answered = time.perf_counter()
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        message = FakeMessage(self, content, **kwargs)
+        self.sent.append(message)
+        return message
+
+
+class FakeAttachment:
+    def __init__(self, data, filename, content_type):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = len(data)
+        self.url = cdn.add(data, filename)
+
+
+# Serves attachment bytes over local HTTP, with Range support, so the bot's
+# pre-flight check and streaming download run as they would against Discord
+class FakeCDN:
+    def __init__(self):
+        self.files = {}
+        self.runner = None
+        self.base = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/{key}/{filename}", self.serve)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def add(self, data, filename):
+        key = str(len(self.files))
+        self.files[key] = data
+        return f"{self.base}/{key}/{filename}"
+
+    async def serve(self, request):
+        data = self.files[request.match_info["key"]]
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+        if match is None:
+            return web.Response(body=data, content_type="application/octet-stream")
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+        return web.Response(
+            status=206, body=data[start:end + 1], content_type="application/octet-stream",
+            headers={"Content-Range": f"bytes {start}-{end}/{len(data)}"},
+        )
+
+
+cdn = FakeCDN()
+
+
+# Fake Gemini client
+
+# Median latency with log-normal spread, a streaming speed, an injected error
+# rate, the number of state polls before an uploaded file becomes ACTIVE and
+# the upload bandwidth (bytes/s) that request payloads are sent at.
+class FakeProfile:
+    def __init__(self, latency=0.5, sigma=0.3, chars_per_second=400.0, chunk_chars=40,
+                 response_chars=1200, error_rate=0.0, processing_polls=2, bandwidth=50e6):
+        self.latency = latency
+        self.sigma = sigma
+        self.chars_per_second = chars_per_second
+        self.chunk_chars = chunk_chars
+        self.response_chars = response_chars
+        self.error_rate = error_rate
+        self.processing_polls = processing_polls
+        self.bandwidth = bandwidth
+        self.payload_bytes = 0
+        self.calls = 0
+
+    def delay(self, payload=0):
+        latency = self.latency * random.lognormvariate(0, self.sigma) if self.latency else 0
+        return latency + payload / self.bandwidth
+
+    def maybe_fail(self):
+        if random.random() < self.error_rate:
+            raise errors.ServerError(503, {"error": {"message": "injected failure"}})
+
+
+def response(text):
+    return types.GenerateContentResponse(candidates=[types.Candidate(
+        content=types.Content(role="model", parts=[types.Part(text=text)]),
+        finish_reason="STOP",
+    )])
+
+
+def count_payload(contents):
+    size = 0
+    for item in contents if isinstance(contents, list) else [contents]:
+        if isinstance(item, str):
+            size += len(item.encode("utf-8"))
+        elif isinstance(item, types.Part) and item.inline_data is not None:
+            size += len(item.inline_data.data)
+        elif isinstance(item, types.Content):
+            size += count_payload(list(item.parts or []))
+    return size
+
+
+# Subclasses the SDK's Models so chat sessions accept it as their backend
+class FakeModels(models.Models):
+    def __init__(self, profile):
+        self.profile = profile
+
+    def answer(self):
+        words = "lorem ipsum dolor sit amet consectetur adipiscing elit".split()
+        text = " ".join(random.choice(words) for _ in range(self.profile.response_chars // 6))
+        return text[:self.profile.response_chars]
+
+    def generate_content(self, *, model, contents, config=None):
+        self.profile.calls += 1
+        payload = count_payload(contents)
+        self.profile.payload_bytes += payload
+        time.sleep(self.profile.delay(payload))
+        self.profile.maybe_fail()
+        # The whole answer is generated before it is returned
+        text = self.answer()
+        time.sleep(len(text) / self.profile.chars_per_second)
+        return response(text)
+
+    def generate_content_stream(self, *, model, contents, config=None):
+        self.profile.calls += 1
+        payload = count_payload(contents)
+        self.profile.payload_bytes += payload
+        time.sleep(self.profile.delay(payload))
+        self.profile.maybe_fail()
+        text = self.answer()
+        step = self.profile.chunk_chars
+        for i in range(0, len(text), step):
+            time.sleep(step / self.profile.chars_per_second)
+            yield response(text[i:i + step])
+
+
+class FakeFiles:
+    def __init__(self, profile):
+        self.profile = profile
+        self.polls = {}
+        self.count = 0
+
+    def upload(self, *, file, config=None):
+        data = file.read()
+        self.profile.payload_bytes += len(data)
+        time.sleep(self.profile.delay(len(data)))
+        self.profile.maybe_fail()
+        self.count += 1
+        name = f"files/benchmark-{self.count}"
+        self.polls[name] = 0
+        return types.File(name=name, uri=f"https://files.example/{name}",
+                          mime_type=config.mime_type, state="PROCESSING")
+
+    def get(self, *, name):
+        time.sleep(self.profile.latency / 10)
+        self.polls[name] = self.polls.get(name, 0) + 1
+        state = "ACTIVE" if self.polls[name] >= self.profile.processing_polls else "PROCESSING"
+        return types.File(name=name, uri=f"https://files.example/{name}", mime_type="video/mp4", state=state)
+
+
+class FakeChats:
+    def __init__(self, models_):
+        self.models = models_
+
+    def create(self, *, model, config=None, history=None):
+        return Chat(modules=self.models, model=model, config=config, history=history or [])
+
+
+class FakeClient:
+    def __init__(self, profile):
+        self.models = FakeModels(profile)
+        self.files = FakeFiles(profile)
+        self.chats = FakeChats(self.models)
+
+
+# Sample attachments. Every request gets distinct bytes so the upload and
+# response caches do not turn the run into a cache benchmark.
+
+# A photo-like picture: a colour gradient with some sensor noise, which keeps
+# it from compressing unrealistically well
+def photo(width, height, mode="RGB"):
+    gradient = Image.radial_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 24)
+    bands = [Image.blend(gradient, noise, 0.15), gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), noise]
+    if mode == "RGBA":
+        bands.append(gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM))
+    return Image.merge(mode, bands[:len(mode)])
+
+
+def encode(image, fmt, **kwargs):
+    out = io.BytesIO()
+    image.save(out, fmt, **kwargs)
+    return out.getvalue()
+
+
+# The images /describe is benchmarked with, used in turn: (bytes, extension,
+# content type)
+def sample_images():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise to display
+    return [
+        (encode(photo(4032, 3024), "JPEG", quality=92), "jpg", "image/jpeg"),  # phone camera
+        (encode(photo(1600, 1200, "RGBA"), "PNG"), "png", "image/png"),  # screenshot with transparency
+        (encode(photo(4032, 3024), "JPEG", quality=92, exif=exif), "jpg", "image/jpeg"),  # taken sideways
+        (encode(photo(640, 480), "JPEG", quality=85), "jpg", "image/jpeg"),  # already small
+    ]
+
+
+# CD-quality stereo WAV: one second of a chord with a different tone on each
+# channel, repeated
+def sample_audio(seconds=30, rate=44100):
+    second = array.array("h")
+    for i in range(rate):
+        t = i / rate
+        second.append(int(8000 * math.sin(2 * math.pi * 220 * t) + 4000 * math.sin(2 * math.pi * 660 * t)))
+        second.append(int(8000 * math.sin(2 * math.pi * 330 * t) + 4000 * math.sin(2 * math.pi * 990 * t)))
+    out = io.BytesIO()
+    with wave.open(out, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(second.tobytes() * seconds)
+    return out.getvalue()
+
+
+# A text PDF with `pages` pages of about 2,000 characters each
+def sample_pdf(pages=100):
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        lines = [" ".join(words[(page + line + k) % len(words)] for k in range(12)) for line in range(30)]
+        stream = "BT /F1 9 Tf 40 800 Td 12 TL " + " ".join(f"({text}) '" for text in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode())
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {len(objects)} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> >> >>".encode())
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode()
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    out.write("".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+def make_request(command, i, samples, latency):
+    unique = f"{i}-{random.random()}".encode()
+    if command == "ask":
+        return FakeContext(command, latency=latency, user=i % 20), {"question": f"Question number {i}?"}
+    if command == "chat":
+        return FakeContext(command, latency=latency, user=i % 20), {"message": f"Message number {i}"}
+    if command == "describe":
+        # JPEG and PNG decoders ignore bytes after the end of the image
+        data, extension, content_type = samples["images"][i % len(samples["images"])]
+        attachment = FakeAttachment(data + unique, f"image{i}.{extension}", content_type)
+    elif command == "summarize":
+        attachment = FakeAttachment(samples["pdf"] + b"%" + unique + b"\n", f"doc{i}.pdf", "application/pdf")
+    elif command == "summarize_audio":
+        attachment = FakeAttachment(samples["audio"] + unique, f"audio{i}.wav", "audio/wav")
+    elif command == "describe_video":
+        attachment = FakeAttachment(b"\x00\x00\x00\x18ftypmp42" + unique + bytes(500_000),
+                                    f"video{i}.mp4", "video/mp4")
+    else:
+        raise ValueError(f"unknown command {command}")
+    return FakeContext(command, attachments=[attachment], latency=latency, user=i % 20), {}
+
+
+# Measurements
+
+# Samples how late a 10 ms timer fires; a blocked event loop shows up as lag
+async def monitor_lag(samples, stop, interval=0.01):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def invoke(command, ctx, kwargs):
+    ctx.started = time.perf_counter()
+    await bot.set_request_context(ctx)
+    try:
+        await command.callback(ctx, **kwargs)
+    finally:
+        await bot.record_total(ctx)
+
+
+async def run_command(name, requests, concurrency, profile, samples, latency):
+    command = bot.bot.get_command(name)
+    bot.timings.clear()
+    profile.payload_bytes = 0
+    profile.calls = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+    contexts = []
+
+    async def one(i):
+        nonlocal failures
+        ctx, kwargs = make_request(name, i, samples, latency)
+        contexts.append(ctx)
+        async with semaphore:
+            try:
+                await invoke(command, ctx, kwargs)
+            except Exception:
+                failures += 1
+
+    lag = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_lag(lag, stop))
+    tracemalloc.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(asyncio.create_task(one(i)) for i in range(requests)))
+    if name in bot.JOB_COMMANDS:
+        # The command only queues a job; wait for the workers to finish them
+        await bot.job_queue.queue.join()
+        failures += bot.job_queue.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE command = ? AND state = 'failed'", (name,)
+        ).fetchone()[0]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stop.set()
+    await monitor
+    answered = [ctx.answered - ctx.started for ctx in contexts if ctx.answered is not None]
+    return {
+        "elapsed": elapsed,
+        "rps": requests / elapsed,
+        "failures": failures,
+        "lag_p50": percentile(lag, 0.5),
+        "lag_p99": percentile(lag, 0.99),
+        "lag_max": max(lag, default=0.0),
+        "peak_mb": peak / 1e6,
+        "payload_kb": profile.payload_bytes / 1e3 / requests,
+        "messages": sum(len(ctx.sent) for ctx in contexts) / requests,
+        "edits": sum(ctx.edits for ctx in contexts) / requests,
+        "answer_p50": percentile(answered, 0.5),
+        "answer_p95": percentile(answered, 0.95),
+        "stages": {stage: histogram for (cmd, stage), histogram in bot.timings.items() if cmd == name},
+    }
+
+
+# Sends images to Gemini as uploaded, for comparing against preprocess_image
+def original_image(data, **kwargs):
+    return data, Image.MIME[Image.open(io.BytesIO(data)).format]
+
+
+def report(name, result):
+    print(f"\n== {name} ==")
+    print(f"  {result['rps']:.1f} req/s over {result['elapsed']:.2f}s, {result['failures']} failed")
+    print(f"  event-loop lag p50 {result['lag_p50'] * 1000:.1f} ms, "
+          f"p99 {result['lag_p99'] * 1000:.1f} ms, max {result['lag_max'] * 1000:.1f} ms")
+    print(f"  memory high-water {result['peak_mb']:.1f} MB, "
+          f"{result['payload_kb']:.1f} kB sent to Gemini per request, "
+          f"{result['messages']:.1f} messages and {result['edits']:.1f} edits per request")
+    print(f"  first visible answer p50 {result['answer_p50']:.3f}s, p95 {result['answer_p95']:.3f}s")
+    print(f"  {'stage':<12}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for stage, histogram in sorted(result["stages"].items()):
+        print(f"  {stage:<12}{histogram.count:>7}"
+              + "".join(f"{histogram.percentile(q):>9.3f}" for q in (0.5, 0.95, 0.99)))
+
+
+# Cost of one log call on the event loop thread. Uses the bot's queue handler
+# on a queue nobody drains, so only the enqueue side is measured.
+def bench_logging(count=20000):
+    logger = bot.logging.getLogger("benchmark")
+    logger.addHandler(bot.BufferedHandler(bot.queue.SimpleQueue()))
+    logger.propagate = False
+    body = "x" * 4000
+    start = time.perf_counter()
+    for _ in range(count):
+        logger.warning("Bot Sending: %s", bot.Truncated(body))
+    per_call = (time.perf_counter() - start) / count
+    print(f"\n== logging ==\n  {per_call * 1e6:.1f} us per logged message body")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the bot's commands.")
+    parser.add_argument("--commands", default="ask,chat,describe,summarize,summarize_audio,describe_video")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.5, help="median Gemini latency (s)")
+    parser.add_argument("--sigma", type=float, default=0.3, help="log-normal spread of the latency")
+    parser.add_argument("--chars-per-second", type=float, default=400.0, help="streaming speed")
+    parser.add_argument("--response-chars", type=int, default=1200)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with 503")
+    parser.add_argument("--processing-polls", type=int, default=2)
+    parser.add_argument("--upload-mbps", type=float, default=400.0,
+                        help="bandwidth for sending request payloads to Gemini (Mbit/s)")
+    parser.add_argument("--audio-seconds", type=int, default=30, help="length of the sample recording")
+    parser.add_argument("--pdf-pages", type=int, default=100, help="pages of the sample PDF")
+    parser.add_argument("--discord-latency", type=float, default=0.02)
+    parser.add_argument("--gemini-concurrency", type=int, default=bot.GEMINI_CONCURRENCY,
+                        help="size of the bot's Gemini worker pool")
+    parser.add_argument("--job-workers", type=int, default=bot.JOB_WORKERS,
+                        help="number of background job workers")
+    parser.add_argument("--no-stream", action="store_true", help="benchmark with STREAM_RESPONSES off")
+    parser.add_argument("--preprocess", choices=["on", "off", "both"], default="on",
+                        help="downscale images before sending them (both: run /describe each way and compare)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    profile = FakeProfile(args.latency, args.sigma, args.chars_per_second,
+                          response_chars=args.response_chars, error_rate=args.error_rate,
+                          processing_polls=args.processing_polls, bandwidth=args.upload_mbps * 1e6 / 8)
+    bot.client_gemini = FakeClient(profile)
+    bot.STREAM_RESPONSES = not args.no_stream
+    bot.gemini_executor = ThreadPoolExecutor(max_workers=args.gemini_concurrency, thread_name_prefix="gemini")
+    bot.GEMINI_BACKOFF = 0.05
+    bot.job_queue.workers = args.job_workers
+    bot.job_queue.start()
+    await cdn.start()
+    if bot.HAVE_PYPDF:
+        # Fork the PDF workers now: started under tracemalloc they would run traced
+        await bot.in_pdf_pool(os.getpid)
+
+    samples = {"images": sample_images(), "audio": sample_audio(args.audio_seconds), "pdf": sample_pdf(args.pdf_pages)}
+    preprocess_image = bot.preprocess_image
+    modes = {"on": [True], "off": [False], "both": [True, False]}[args.preprocess]
+    compared = {}
+    for name in args.commands.split(","):
+        name = name.strip()
+        for preprocess in modes if name == "describe" else [True]:
+            bot.preprocess_image = preprocess_image if preprocess else original_image
+            result = await run_command(name, args.requests, args.concurrency, profile,
+                                       samples, args.discord_latency)
+            label = name if preprocess else f"{name} (no preprocessing)"
+            report(label, result)
+            compared[label] = result
+    bot.preprocess_image = preprocess_image
+    if args.preprocess == "both" and "describe" in compared:
+        print("\n== image preprocessing ==")
+        for label in ("describe", "describe (no preprocessing)"):
+            total = compared[label]["stages"].get("total")
+            print(f"  {label:<28}{compared[label]['payload_kb']:>9.1f} kB per request, end-to-end p50 "
+                  f"{total.percentile(0.5) if total else 0:.3f}s, p95 {total.percentile(0.95) if total else 0:.3f}s")
+    await bot.close_http_session()
+    await cdn.stop()
+    bench_logging()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,14 +1,39 @@
+import time
+STARTED = time.perf_counter()
 import discord
+import aiohttp
 from discord.ext import commands
+from discord import app_commands
 from dotenv import load_dotenv
 import os
-from google import genai
-from google.genai import types
-import requests
+import importlib
+import importlib.util
 import pathlib
-from PIL import Image
+import io
+import tempfile
+import mimetypes
+import wave
 import sys
-import time
+import hashlib
+import sqlite3
+import asyncio
+import functools
+import json
+from collections import OrderedDict
+import random
+import re
+import threading
+import contextlib
+import contextvars
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import atexit
+import logging
+import logging.handlers
+import queue
+import signal
+import subprocess
+from typing import Optional
 
 
 # Load environment variables
@@ -16,199 +41,2422 @@ load_dotenv()
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 GOOGLE_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# Initialize Google Gemini client
-client_gemini = genai.Client(api_key=GOOGLE_API_KEY)
+# Logging goes through a queue: the event loop only enqueues records, and a
+# background thread formats them and writes them to stdout and to a rotating
+# LOG_FILE. Message bodies are cut to LOG_BODY_LIMIT characters (when the
+# record is written, not when it is logged) and only a LOG_BODY_SAMPLE
+# fraction of them is logged at all.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_BODY_LIMIT = int(os.getenv("LOG_BODY_LIMIT", "200"))
+LOG_BODY_SAMPLE = float(os.getenv("LOG_BODY_SAMPLE", "1.0"))
+
+# Hands records to the writer thread as they are, leaving all formatting to it
+class BufferedHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+class Truncated:
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        text = str(self.text)
+        if len(text) <= LOG_BODY_LIMIT:
+            return text
+        return f"{text[:LOG_BODY_LIMIT]}... ({len(text)} chars)"
+
+def log_body():
+    return LOG_BODY_SAMPLE >= 1 or random.random() < LOG_BODY_SAMPLE
+
+log = logging.getLogger("bot")
+log_queue = queue.SimpleQueue()
+
+def setup_logging():
+    if hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(errors="replace")
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+            encoding="utf-8", errors="replace",
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    log.addHandler(BufferedHandler(log_queue))
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+
+setup_logging()
+
+# google-genai (with httpx) and Pillow take most of the startup time, so they
+# are imported on first use. Each import is timed and logged, like
+# `python -X importtime`, and shows up in /stats under "startup". Once the bot
+# is ready, warm_up() loads them on a worker thread, so normally no command has
+# to wait for an import on the event loop.
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                start = time.perf_counter()
+                self._module = importlib.import_module(self._name)
+                elapsed = time.perf_counter() - start
+                observe(f"import {self._name}", elapsed, command="startup")
+                log.info("Imported %s in %.3fs", self._name, elapsed)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+genai = LazyModule("google.genai")
+types = LazyModule("google.genai.types")
+errors = LazyModule("google.genai.errors")
+httpx = LazyModule("httpx")
+Image = LazyModule("PIL.Image")
+ImageOps = LazyModule("PIL.ImageOps")
+
+# Initialize Google Gemini client on first use. The HTTP timeout (GEMINI_TIMEOUT,
+# in milliseconds here) ends a hung request in its worker thread; the
+# asyncio.wait_for around each call only stops the command from waiting on it.
+class LazyClient:
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._client is None:
+                self._client = genai.Client(
+                    api_key=GOOGLE_API_KEY,
+                    http_options=types.HttpOptions(timeout=int(GEMINI_TIMEOUT * 1000)),
+                )
+        return self._client
+
+    def __getattr__(self, attr):
+        return getattr(self._client or self._load(), attr)
+
+client_gemini = LazyClient()
+
+def warm_up():
+    try:
+        for module in (genai, types, errors, httpx, Image, ImageOps):
+            module._load()
+        client_gemini._load()
+    except Exception as e:
+        log.warning("Warm-up failed, modules load on first use instead: %s", e)
 MODEL_ID = "gemini-2.0-flash-exp"
 
-# Set up the bot
+# Gemini SDK calls are blocking, so they run on a bounded worker pool instead of
+# the discord.py event loop. GEMINI_CONCURRENCY caps how many run at once.
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "32"))
+gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_CONCURRENCY, thread_name_prefix="gemini")
+
+# SQLite databases may be shared by several bot processes (see BOT_PROCESSES),
+# so they use WAL mode and wait for each other's locks. That wait can last up
+# to 30 seconds, so once the bot is running every query goes through
+# in_db_thread(), which runs it on shared_state_executor instead of the event
+# loop (one thread, so each connection is only used by one query at a time).
+shared_state_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+
+def open_db(path):
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+async def in_db_thread(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(shared_state_executor, functools.partial(func, *args, **kwargs))
+
+# Sharding: SHARD_COUNT is the total number of gateway shards and SHARD_IDS the
+# comma-separated shards this process runs. With BOT_PROCESSES > 1, running
+# bot.py starts a supervisor that spreads the shards over that many worker
+# processes and restarts any worker that exits.
+SHARD_COUNT = os.getenv("SHARD_COUNT")
+SHARD_IDS = os.getenv("SHARD_IDS")
+BOT_PROCESSES = int(os.getenv("BOT_PROCESSES", "1"))
+
+# Set up the bot. Every command is a hybrid command: it works both as a
+# "/name" prefix command and as a native slash command. With PREFIX_COMMANDS=0
+# only slash commands are served, so the bot asks for neither the privileged
+# message content intent nor guild message events.
+PREFIX_COMMANDS = os.getenv("PREFIX_COMMANDS", "1") == "1"
 intents = discord.Intents.default()
-intents.messages = True
-intents.message_content = True
-bot = commands.Bot(command_prefix="/", intents=intents)
+intents.messages = PREFIX_COMMANDS
+intents.message_content = PREFIX_COMMANDS
+if SHARD_COUNT or SHARD_IDS:
+    bot = commands.AutoShardedBot(
+        command_prefix="/",
+        intents=intents,
+        shard_count=int(SHARD_COUNT) if SHARD_COUNT else None,
+        shard_ids=[int(shard_id) for shard_id in SHARD_IDS.split(",")] if SHARD_IDS else None,
+    )
+else:
+    bot = commands.Bot(command_prefix="/", intents=intents)
 
 
 # Remove the default help command before defining our own.
 bot.remove_command("help")
 
-async def send_long_message(ctx, prefix, text):
-    max_length = 1990 - len(prefix)
-    if len(text) == 0:
-        await ctx.send("**No response was generated.**")
+# Long answers are split on paragraph, line, sentence and word boundaries (in
+# that order of preference). A code block cut in two is closed at the end of
+# one message and re-opened with the same language at the start of the next.
+FENCE = "```"
+
+def fence_after(text, fence):
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if stripped.startswith(FENCE):
+            fence = None if fence else stripped
+    return fence
+
+def cut_point(text, budget):
+    window = text[:budget]
+    for separator in ("\n\n", "\n", ". ", "! ", "? ", "\u3002", " "):
+        index = window.rfind(separator)
+        if index >= budget // 3:
+            return index + len(separator)
+    return budget
+
+# Take the next message-sized chunk (at most `limit` characters) off `text`,
+# which starts inside the code block opened by `fence` (None if it does not).
+# Returns the chunk, how many characters of `text` it used, and the fence
+# that is still open after it.
+def next_chunk(text, limit, fence=None):
+    opening = f"{fence}\n" if fence else ""
+    if len(opening) + len(text) <= limit:
+        return opening + text, len(text), fence_after(text, fence)
+    used = cut_point(text, limit - len(opening) - len("\n" + FENCE))
+    piece = text[:used]
+    fence = fence_after(piece, fence)
+    chunk = opening + piece.rstrip()
+    if fence:
+        chunk += "\n" + FENCE
+    else:
+        # Outside code, whitespace at the cut would only start the next chunk
+        while used < len(text) and text[used] in " \n":
+            used += 1
+    return chunk, used, fence
+
+def split_message(text, limit):
+    chunks = []
+    fence = None
+    while text:
+        chunk, used, fence = next_chunk(text, limit, fence)
+        if chunk.strip():
+            chunks.append(chunk)
+        text = text[used:]
+    return chunks
+
+def with_prefix(prefix, chunk):
+    # A code fence only renders at the start of a line
+    if prefix and chunk.startswith(FENCE):
+        return f"{prefix}\n{chunk}"
+    return f"{prefix}{chunk}"
+
+# Answers longer than MESSAGE_FILE_THRESHOLD messages are posted as a single
+# response.md attachment instead of a run of messages.
+MESSAGE_FILE_THRESHOLD = int(os.getenv("MESSAGE_FILE_THRESHOLD", "5"))
+
+# Post text as a response.md attachment, in the placeholder message if given
+async def send_attached(ctx, prefix, text, placeholder=None):
+    content = f"{prefix}The full response ({len(text)} characters) is attached."
+    file = discord.File(io.BytesIO(text.encode("utf-8")), filename="response.md")
+    if placeholder is not None:
+        with span("send"):
+            await placeholder.edit(content=content, attachments=[file])
+    else:
+        await safe_send(ctx, content, file=file)
+
+# Post text split into Discord-sized messages. When a placeholder (status)
+# message is given, it is edited to hold the first part.
+async def send_long_message(ctx, prefix, text, placeholder=None):
+    if not text:
+        if placeholder is not None:
+            await placeholder.edit(content="**No response was generated.**")
+        else:
+            await ctx.send("**No response was generated.**")
         return
 
-    for i in range(0, len(text), max_length):
-        part = text[i:i + max_length]
-        await safe_send(ctx, f"{prefix}{part}")
+    chunks = split_message(text, 1989 - len(prefix))
+    if len(chunks) > MESSAGE_FILE_THRESHOLD:
+        await send_attached(ctx, prefix, text, placeholder)
+        return
+    for i, chunk in enumerate(chunks):
+        if i == 0 and placeholder is not None:
+            with span("send"):
+                await placeholder.edit(content=with_prefix(prefix, chunk))
+        else:
+            await safe_send(ctx, with_prefix(prefix, chunk))
 
-# 包裝 send 方法，印出訊息內容
-async def safe_send(ctx, content):
+# Who a Gemini call is made for. Set for every command invocation so the
+# scheduler can queue calls fairly without threading it through each helper.
+request_context = contextvars.ContextVar("request_context", default=None)
+
+# Priority lanes: lower numbers are served first, so a quick /ask never waits
+# behind a queue of video or audio jobs.
+COMMAND_LANES = {"summarize": 1, "ask_doc": 1, "summarize_audio": 2, "describe_video": 2}
+
+@bot.before_invoke
+async def set_request_context(ctx):
+    # Slash commands must be answered within 3 seconds; deferring shows
+    # "thinking..." and lets every later ctx.send become a follow-up.
+    if ctx.interaction is not None:
+        await ctx.defer()
+    request_context.set({
+        "command": ctx.command.name,
+        "lane": COMMAND_LANES.get(ctx.command.name, 0),
+        "guild": ctx.guild.id if ctx.guild else None,
+        "user": ctx.author.id,
+        "started": time.perf_counter(),
+    })
+
+# Timing histograms per (command, stage). Stages are download, preprocess,
+# upload, poll, queue, generate, first_token (time until the first streamed
+# chunk is visible), send and total, plus extract (PDF text extraction), and
+# job_wait and job for background jobs.
+class Histogram:
+    def __init__(self, size=2048):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+timings = defaultdict(Histogram)
+
+def observe(stage, seconds, command=None):
+    if command is None:
+        command = (request_context.get() or {}).get("command", "background")
+    timings[(command, stage)].observe(seconds)
+
+@contextlib.contextmanager
+def span(stage, command=None):
+    start = time.perf_counter()
     try:
-        sys.stdout.buffer.write(f"Bot Sending: {content}\n".encode('utf-8', 'replace'))
-    except Exception as e:
-        print(f"Error printing to console: {e}")
-    await ctx.send(content)
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, command)
+
+@bot.after_invoke
+async def record_total(ctx):
+    info = request_context.get()
+    if info is not None:
+        observe("total", time.perf_counter() - info["started"])
+
+# Token bucket refilled at `rate` tokens per second, holding at most `burst`.
+class TokenBucket:
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated = clock()
+
+    # Seconds until a token is available (0 when one is available now)
+    def delay(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+# Token bucket stored in SQLite so that every bot process draws from the same
+# budget. Uses wall-clock time since the processes share no monotonic clock.
+# The scheduler runs its methods with in_db_thread().
+class SharedTokenBucket:
+    def __init__(self, db, name, rate, burst):
+        self.db = db
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    @staticmethod
+    def open(path):
+        db = open_db(path)
+        db.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        return db
+
+    def delay(self):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute(
+                "INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)", (self.name, self.burst, time.time())
+            )
+            tokens, updated = self.db.execute(
+                "SELECT tokens, updated FROM buckets WHERE name = ?", (self.name,)
+            ).fetchone()
+            now = time.time()
+            tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+            self.db.execute(
+                "UPDATE buckets SET tokens = ?, updated = ? WHERE name = ?", (tokens, now, self.name)
+            )
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self):
+        with self.db:
+            self.db.execute("UPDATE buckets SET tokens = tokens - 1 WHERE name = ?", (self.name,))
+
+# Set by the supervisor for its workers so rate limits hold across processes
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH")
+
+# Central queue in front of every Gemini call. Calls are rate limited with a
+# token bucket per model and one per API key, served by priority lane, and
+# within a lane round-robin across guilds and then across users, so one busy
+# guild cannot starve the others. The clock and sleep function can be swapped
+# for fakes to drive the scheduler deterministically.
+GEMINI_MODEL_RPM = float(os.getenv("GEMINI_MODEL_RPM", "60"))
+GEMINI_KEY_RPM = float(os.getenv("GEMINI_KEY_RPM", "120"))
+GEMINI_BURST = float(os.getenv("GEMINI_BURST", "10"))
+
+class GeminiScheduler:
+    def __init__(self, model_rpm=GEMINI_MODEL_RPM, key_rpm=GEMINI_KEY_RPM, burst=GEMINI_BURST,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        self.model_rpm = model_rpm
+        self.key_rpm = key_rpm
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.buckets = {}
+        self.shared_db = SharedTokenBucket.open(SHARED_STATE_PATH) if SHARED_STATE_PATH else None
+        self.lanes = {}  # lane -> guild -> user -> deque of waiters
+        self.wakeup = None
+        self.task = None
+        self.waits = deque(maxlen=1000)  # (lane, seconds spent queued)
+
+    def bucket(self, kind, name):
+        key = (kind, name)
+        if key not in self.buckets:
+            rpm = self.model_rpm if kind == "model" else self.key_rpm
+            if self.shared_db is not None:
+                if kind == "key":
+                    name = hashlib.sha256(str(name).encode("utf-8")).hexdigest()[:16]
+                self.buckets[key] = SharedTokenBucket(self.shared_db, f"{kind}:{name}", rpm / 60, self.burst)
+            else:
+                self.buckets[key] = TokenBucket(rpm / 60, self.burst, self.clock)
+        return self.buckets[key]
+
+    def depth(self):
+        return {
+            lane: sum(len(waiters) for users in guilds.values() for waiters in users.values())
+            for lane, guilds in self.lanes.items()
+        }
+
+    # Queue wait percentile per lane over the last 1000 calls
+    def wait_percentiles(self, q):
+        by_lane = defaultdict(list)
+        for lane, seconds in self.waits:
+            by_lane[lane].append(seconds)
+        return {
+            lane: sorted(waits)[min(len(waits) - 1, int(q * len(waits)))]
+            for lane, waits in sorted(by_lane.items())
+        }
+
+    async def call(self, bucket, method):
+        if isinstance(bucket, SharedTokenBucket):
+            return await in_db_thread(getattr(bucket, method))
+        return getattr(bucket, method)()
+
+    # Wait for a turn to call `model` (None for Files API calls, which only
+    # count against the API key).
+    async def acquire(self, model=None, api_key=GOOGLE_API_KEY):
+        info = request_context.get() or {}
+        lane = info.get("lane", 0)
+        waiter = {
+            "future": asyncio.get_running_loop().create_future(),
+            "buckets": [self.bucket("key", api_key)] + ([self.bucket("model", model)] if model else []),
+            "queued": self.clock(),
+            "lane": lane,
+        }
+        users = self.lanes.setdefault(lane, {}).setdefault(info.get("guild"), {})
+        users.setdefault(info.get("user"), deque()).append(waiter)
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        with span("queue"):
+            await waiter["future"]
+
+    # The next waiter in fair order; with remove=True it is taken off the
+    # queue and its guild and user move to the back of the rotation.
+    def next_waiter(self, remove=False):
+        for lane in sorted(self.lanes):
+            guilds = self.lanes[lane]
+            while guilds:
+                guild = next(iter(guilds))
+                users = guilds[guild]
+                user = next(iter(users))
+                waiters = users[user]
+                while waiters and waiters[0]["future"].done():
+                    waiters.popleft()
+                if not waiters:
+                    del users[user]
+                    if not users:
+                        del guilds[guild]
+                    continue
+                if not remove:
+                    return waiters[0]
+                waiter = waiters.popleft()
+                del users[user]
+                if waiters:
+                    users[user] = waiters
+                del guilds[guild]
+                if users:
+                    guilds[guild] = users
+                return waiter
+            del self.lanes[lane]
+        return None
+
+    async def run(self):
+        while True:
+            waiter = self.next_waiter()
+            if waiter is None:
+                return
+            try:
+                await self.serve(waiter)
+            except Exception as e:
+                # A shared bucket can fail (e.g. its database stays locked past
+                # the busy timeout): fail this call instead of leaving the
+                # whole queue waiting
+                log.warning("Rate limiter failed: %s", e)
+                if self.next_waiter() is waiter:
+                    self.next_waiter(remove=True)
+                if not waiter["future"].done():
+                    waiter["future"].set_exception(e)
+
+    # Grant the waiter at the head of the queue its turn, or sleep until the
+    # buckets allow it
+    async def serve(self, waiter):
+        delay = max([await self.call(bucket, "delay") for bucket in waiter["buckets"]])
+        if delay > 0:
+            # Sleep until tokens refill, or until a new (maybe higher
+            # priority) request arrives
+            self.wakeup.clear()
+            sleeper = asyncio.ensure_future(self.sleep(delay))
+            woken = asyncio.ensure_future(self.wakeup.wait())
+            await asyncio.wait([sleeper, woken], return_when=asyncio.FIRST_COMPLETED)
+            sleeper.cancel()
+            woken.cancel()
+            return
+        # A request that arrived (or was cancelled) while the buckets were
+        # checked changes who is next
+        if self.next_waiter() is not waiter:
+            return
+        self.next_waiter(remove=True)
+        for bucket in waiter["buckets"]:
+            await self.call(bucket, "take")
+        self.waits.append((waiter["lane"], self.clock() - waiter["queued"]))
+        if not waiter["future"].done():
+            waiter["future"].set_result(None)
+
+gemini_scheduler = GeminiScheduler()
+
+# Calls that fail with a rate limit (429), a server error (5xx), a timeout or
+# a connection problem are retried up to GEMINI_RETRIES times with jittered
+# exponential backoff; each attempt gets GEMINI_TIMEOUT seconds. After
+# BREAKER_THRESHOLD consecutive failures of that kind the circuit breaker
+# opens and calls fail immediately for BREAKER_COOLDOWN seconds, after which a
+# single trial call decides whether it closes again.
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "3"))
+GEMINI_BACKOFF = float(os.getenv("GEMINI_BACKOFF", "1"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "120"))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+class GeminiUnavailable(Exception):
+    pass
+
+def is_retryable(error):
+    if isinstance(error, errors.APIError):
+        return error.code == 429 or (error.code or 0) >= 500
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError, httpx.TransportError))
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial = None  # when the half-open trial call started
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        # A trial that never reported back (e.g. was cancelled) is replaced
+        # after another cooldown
+        if state == "half-open" and (self.trial is None or self.clock() - self.trial >= self.cooldown):
+            self.trial = self.clock()
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = None
+
+    def failure(self):
+        self.failures += 1
+        if self.trial is not None or self.failures >= self.threshold:
+            self.opened_at = self.clock()
+        self.trial = None
+
+gemini_breaker = CircuitBreaker()
+
+async def start_attempt(model):
+    if not gemini_breaker.allow():
+        raise GeminiUnavailable("Gemini is unavailable right now, please try again later.")
+    await gemini_scheduler.acquire(model)
+
+# Record a failed attempt; returns True after backing off when it should be retried
+async def retry_after(error, attempt):
+    if not is_retryable(error):
+        # A 4xx answer shows Gemini is up even though the request was rejected;
+        # anything else (a local bug, say) says nothing about it
+        if isinstance(error, errors.APIError) and 400 <= (error.code or 0) < 500:
+            gemini_breaker.success()
+        return False
+    gemini_breaker.failure()
+    if attempt >= GEMINI_RETRIES:
+        return False
+    await asyncio.sleep(random.uniform(0, GEMINI_BACKOFF * 2 ** attempt))
+    return True
+
+# Run a blocking Gemini call on the worker pool and await its result. Chat
+# session calls pass quota_model since the model is not among their arguments.
+async def run_gemini(func, *args, quota_model=None, **kwargs):
+    loop = asyncio.get_running_loop()
+    attempt = 0
+    while True:
+        await start_attempt(kwargs.get("model", quota_model))
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(gemini_executor, functools.partial(func, *args, **kwargs)),
+                GEMINI_TIMEOUT,
+            )
+        except Exception as e:
+            if not await retry_after(e, attempt):
+                raise
+            attempt += 1
+            continue
+        gemini_breaker.success()
+        return result
+
+# Run a blocking streaming Gemini call on the worker pool and yield its text
+# chunks on the event loop as they arrive. Only failures before the first
+# chunk are retried; GEMINI_TIMEOUT bounds the wait for each chunk.
+async def stream_gemini(func, *args, quota_model=None, **kwargs):
+    loop = asyncio.get_running_loop()
+    attempt = 0
+    while True:
+        await start_attempt(kwargs.get("model", quota_model))
+        queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for chunk in func(*args, **kwargs):
+                    if stop.is_set():
+                        break
+                    if chunk.text:
+                        loop.call_soon_threadsafe(queue.put_nowait, chunk.text)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        loop.run_in_executor(gemini_executor, produce)
+        started = False
+        try:
+            while True:
+                item = await asyncio.wait_for(queue.get(), GEMINI_TIMEOUT)
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                started = True
+                yield item
+        except Exception as e:
+            if started:
+                if is_retryable(e):
+                    gemini_breaker.failure()
+                raise
+            if not await retry_after(e, attempt):
+                raise
+            attempt += 1
+            continue
+        finally:
+            stop.set()
+        gemini_breaker.success()
+        return
+
+# Posts a reply while it is still being generated: the first chunk shows up
+# immediately, later chunks edit the same message at most once every
+# STREAM_EDIT_INTERVAL seconds (Discord rate-limits edits), and the text rolls
+# over to a new message once it reaches Discord's 2000-character limit. A reply
+# that would need more than MESSAGE_FILE_THRESHOLD messages is collapsed back
+# into its first message and posted as response.md once it is complete.
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+class StreamingReply:
+    def __init__(self, ctx, prefix, message=None, interval=STREAM_EDIT_INTERVAL):
+        self.ctx = ctx
+        self.prefix = prefix
+        self.message = message
+        self.interval = interval
+        self.text = ""
+        self.start = 0  # offset of the text shown in the current message
+        self.fence = None  # code fence still open where the current message starts
+        self.shown = None
+        self.last_edit = 0.0
+        self.created_at = time.perf_counter()
+        self.first_chunk_at = None
+        self.messages = []  # every message the reply has used so far
+        self.attached = False  # too long: the text is sent as a file at the end
+
+    async def feed(self, chunk):
+        self.text += chunk
+        now = asyncio.get_running_loop().time()
+        if self.attached:
+            return
+        if self.shown is None or now - self.last_edit >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        max_length = 1989 - len(self.prefix)
+        while True:
+            chunk, used, fence = next_chunk(self.text[self.start:], max_length, self.fence)
+            if self.start + used >= len(self.text):
+                break
+            if len(self.messages) >= MESSAGE_FILE_THRESHOLD:
+                await self.collapse()
+                return
+            # The current message is full: finish it and continue in a new one
+            await self.show(chunk)
+            self.start += used
+            self.fence = fence
+            self.message = None
+            self.shown = ""
+        if chunk.strip():
+            await self.show(chunk)
+
+    # Switch to posting the reply as a file: keep the first message as a
+    # status line and delete the rest
+    async def collapse(self):
+        self.attached = True
+        if not self.messages:
+            return
+        first, *rest = self.messages
+        with span("send"):
+            for message in rest:
+                with contextlib.suppress(discord.HTTPException):
+                    await message.delete()
+            await first.edit(content=f"{self.prefix}\u270d\ufe0f Writing a long response, it will be attached...")
+        self.message = first
+        self.messages = [first]
+
+    async def show(self, part):
+        content = with_prefix(self.prefix, part)
+        if content == self.shown:
+            return
+        with span("send"):
+            if self.message is None:
+                self.message = await self.ctx.send(content)
+            else:
+                await self.message.edit(content=content)
+        if not self.messages or self.messages[-1] is not self.message:
+            self.messages.append(self.message)
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+            observe("first_token", self.first_chunk_at - self.created_at)
+        self.shown = content
+        self.last_edit = asyncio.get_running_loop().time()
+
+    async def finish(self):
+        if not self.text:
+            if self.message is not None:
+                await self.message.edit(content="**No response was generated.**")
+            else:
+                await self.ctx.send("**No response was generated.**")
+            return
+        if not self.attached:
+            await self.flush()
+        if self.attached:
+            await send_attached(self.ctx, self.prefix, self.text, self.message)
+
+# Generate a reply from Gemini (or from a chat session) and post it, streaming
+# when STREAM_RESPONSES is on. Returns the full response text.
+async def generate_reply(ctx, prefix, contents, placeholder=None, chat_session=None, model=MODEL_ID, config=None):
+    if chat_session is not None:
+        call, stream_call = chat_session.send_message, chat_session.send_message_stream
+        kwargs = {"message": contents, "quota_model": MODEL_ID}
+    else:
+        call, stream_call = client_gemini.models.generate_content, client_gemini.models.generate_content_stream
+        kwargs = {"model": model, "contents": contents}
+        if config is not None:
+            kwargs["config"] = config
+    if not STREAM_RESPONSES:
+        with span("generate"):
+            response = await run_gemini(call, **kwargs)
+        full_response = response.candidates[0].content.parts[0].text
+        await send_long_message(ctx, prefix, full_response, placeholder)
+        return full_response
+    reply = StreamingReply(ctx, prefix, placeholder)
+    with span("generate"):
+        async for chunk in stream_gemini(stream_call, **kwargs):
+            await reply.feed(chunk)
+    await reply.finish()
+    return reply.text
+
+# Generate a complete response without posting it
+async def generate_text(contents):
+    with span("generate"):
+        response = await run_gemini(client_gemini.models.generate_content, model=MODEL_ID, contents=contents)
+    return response.candidates[0].content.parts[0].text
+
+# Tracks every in-flight Files API upload and polls them together from one
+# background task, resolving each waiting command's future once the file is
+# ACTIVE or FAILED. Each file backs off exponentially (with jitter) while it
+# stays in PROCESSING.
+FILE_POLL_MIN = float(os.getenv("FILE_POLL_MIN", "1"))
+FILE_POLL_MAX = float(os.getenv("FILE_POLL_MAX", "10"))
+
+class FilePoller:
+    def __init__(self, min_delay=FILE_POLL_MIN, max_delay=FILE_POLL_MAX):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.pending = {}  # file name -> {"futures", "delay", "next"}
+        self.wakeup = None
+        self.task = None
+
+    def wait(self, file_upload):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = self.pending.get(file_upload.name)
+        if entry is None:
+            entry = {"futures": [], "delay": self.min_delay, "next": loop.time() + self.min_delay}
+            self.pending[file_upload.name] = entry
+        entry["futures"].append(future)
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+        return future
+
+    def resolve(self, name, file_upload=None, error=None):
+        entry = self.pending.pop(name, None)
+        if entry is None:
+            return
+        for future in entry["futures"]:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(file_upload)
+
+    async def poll(self, name, entry):
+        try:
+            file_upload = await run_gemini(client_gemini.files.get, name=name)
+        except Exception as e:
+            self.resolve(name, error=e)
+            return
+        if file_upload.state in ("ACTIVE", "FAILED"):
+            self.resolve(name, file_upload)
+            return
+        entry["delay"] = min(entry["delay"] * 2, self.max_delay)
+        entry["next"] = asyncio.get_running_loop().time() + entry["delay"] * random.uniform(0.8, 1.2)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while self.pending:
+            # Forget files whose waiting commands have all gone away
+            for name, entry in list(self.pending.items()):
+                if all(future.done() for future in entry["futures"]):
+                    del self.pending[name]
+            if not self.pending:
+                break
+            now = loop.time()
+            due = [(name, entry) for name, entry in self.pending.items() if entry["next"] <= now]
+            if due:
+                await asyncio.gather(*(self.poll(name, entry) for name, entry in due))
+                continue
+            self.wakeup.clear()
+            timeout = min(entry["next"] for entry in self.pending.values()) - now
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+file_poller = FilePoller()
+
+# Content-addressed cache of Files API uploads, keyed by the SHA-256 of the
+# attachment bytes and persisted to SQLite so it survives restarts. Uploaded
+# files expire on Google's side after 48 hours, so entries are evicted a little
+# before that (UPLOAD_CACHE_TTL seconds).
+UPLOAD_CACHE_PATH = os.getenv("UPLOAD_CACHE_PATH", "upload_cache.sqlite3")
+UPLOAD_CACHE_TTL = float(os.getenv("UPLOAD_CACHE_TTL", str(47 * 3600)))
+
+class UploadCache:
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.db = open_db(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS uploads "
+            "(digest TEXT PRIMARY KEY, name TEXT, uri TEXT, mime_type TEXT, expires REAL)"
+        )
+        self.evict_expired()
+
+    async def get(self, digest):
+        row = await in_db_thread(lambda: self.db.execute(
+            "SELECT name, uri, mime_type, expires FROM uploads WHERE digest = ?", (digest,)
+        ).fetchone())
+        if row is None:
+            return None
+        if row[3] <= time.time():
+            await self.discard(digest)
+            return None
+        return types.File(name=row[0], uri=row[1], mime_type=row[2])
+
+    async def put(self, digest, file_upload):
+        expires = time.time() + self.ttl
+        if file_upload.expiration_time is not None:
+            expires = min(expires, file_upload.expiration_time.timestamp() - 60)
+        await in_db_thread(
+            self.write, "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+            (digest, file_upload.name, file_upload.uri, file_upload.mime_type, expires),
+        )
+
+    async def discard(self, digest):
+        await in_db_thread(self.write, "DELETE FROM uploads WHERE digest = ?", (digest,))
+
+    def write(self, sql, params):
+        with self.db:
+            self.db.execute(sql, params)
+
+    def evict_expired(self):
+        self.db.execute("DELETE FROM uploads WHERE expires <= ?", (time.time(),))
+        self.db.commit()
+
+upload_cache = UploadCache(UPLOAD_CACHE_PATH, UPLOAD_CACHE_TTL)
+
+# Cache of generated answers for /ask and /describe, keyed on the command,
+# model, prompt and attachment digest. Recent entries live in an in-memory LRU;
+# setting RESPONSE_CACHE_PATH adds a SQLite tier that outlives restarts. The
+# disk tier is pruned to RESPONSE_CACHE_DISK_SIZE entries every
+# RESPONSE_CACHE_PRUNE_EVERY writes rather than on each one.
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH")
+RESPONSE_CACHE_DISK_SIZE = int(os.getenv("RESPONSE_CACHE_DISK_SIZE", "10000"))
+RESPONSE_CACHE_PRUNE_EVERY = int(os.getenv("RESPONSE_CACHE_PRUNE_EVERY", "100"))
+
+class ResponseCache:
+    def __init__(self, size, ttl, path=None, disk_size=RESPONSE_CACHE_DISK_SIZE,
+                 prune_every=RESPONSE_CACHE_PRUNE_EVERY, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.disk_size = disk_size
+        self.prune_every = prune_every
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (text, expires)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.db = None
+        if path:
+            self.db = open_db(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT, expires REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires)")
+
+    @staticmethod
+    def key(command, model, prompt, attachment_digest=None):
+        raw = json.dumps([command, model, prompt.strip(), attachment_digest])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, key):
+        now = self.clock()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            del self.entries[key]
+        if self.db is not None:
+            row = await in_db_thread(lambda: self.db.execute(
+                "SELECT text, expires FROM responses WHERE key = ? AND expires > ?", (key, now)
+            ).fetchone())
+            if row is not None:
+                self.remember(key, row[0], row[1])
+                self.hits += 1
+                return row[0]
+        self.misses += 1
+        return None
+
+    async def put(self, key, text):
+        expires = self.clock() + self.ttl
+        self.remember(key, text, expires)
+        if self.db is not None:
+            self.writes += 1
+            await in_db_thread(self.store, key, text, expires, self.writes % self.prune_every == 0)
+
+    def store(self, key, text, expires, prune=False):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, text, expires))
+            if prune:
+                self.prune()
+
+    # Drops expired answers, then all but the disk_size that expire last; both
+    # are range scans on the expires index
+    def prune(self):
+        self.db.execute("DELETE FROM responses WHERE expires <= ?", (self.clock(),))
+        self.db.execute(
+            "DELETE FROM responses WHERE expires < "
+            "(SELECT expires FROM responses ORDER BY expires DESC LIMIT 1 OFFSET ?)",
+            (self.disk_size - 1,),
+        )
+
+    def remember(self, key, text, expires):
+        self.entries[key] = (text, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH)
+
+# Identical requests arriving while the first one is still being answered
+# (same response cache key) share its Gemini call instead of making their own.
+# The call runs in a task of its own and is awaited through asyncio.shield, so
+# a cancelled waiter does not cancel it for the others; its result or error is
+# passed to every waiter.
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.shared = 0
+
+    # Returns the result and whether this caller started the call
+    async def run(self, key, func):
+        task = self.calls.get(key)
+        leader = task is None
+        if leader:
+            task = asyncio.ensure_future(func())
+            self.calls[key] = task
+            task.add_done_callback(functools.partial(self.done, key))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task), leader
+
+    def done(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every waiter was cancelled
+
+single_flight = SingleFlight()
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Attachments are read straight into memory. Only attachments larger than
+# ATTACHMENT_SPILL_BYTES go to disk, in a uniquely named temp file that is
+# removed when the handler finishes, even if it raised.
+ATTACHMENT_SPILL_BYTES = int(os.getenv("ATTACHMENT_SPILL_BYTES", str(20 * 1024 * 1024)))
+
+class AttachmentPayload:
+    def __init__(self, filename, content_type, data=None, path=None):
+        self.filename = filename
+        self.mime_type = (
+            content_type
+            or mimetypes.guess_type(filename)[0]
+            or "application/octet-stream"
+        ).split(";")[0]
+        self.data = data
+        self.path = path
+        self.size = len(data) if data is not None else path.stat().st_size
+        self._digest = None
+
+    def open(self):
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.path, "rb")
+
+    def read(self):
+        if self.data is not None:
+            return self.data
+        return self.path.read_bytes()
+
+    async def digest(self):
+        if self._digest is None:
+            if self.data is not None:
+                self._digest = hashlib.sha256(self.data).hexdigest()
+            else:
+                self._digest = await asyncio.get_running_loop().run_in_executor(None, file_digest, self.path)
+        return self._digest
+
+# Before anything is downloaded, an attachment is checked against the limits
+# of the command it was sent with: its size, as reported by Discord, and its
+# type, sniffed from its first bytes (fetched with a Range request) rather
+# than taken from the file name. The download itself is streamed and stops as
+# soon as it goes over the limit.
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+MAX_PDF_BYTES = int(os.getenv("MAX_PDF_BYTES", str(50 * 1024 * 1024)))
+MAX_AUDIO_BYTES = int(os.getenv("MAX_AUDIO_BYTES", str(200 * 1024 * 1024)))
+MAX_VIDEO_BYTES = int(os.getenv("MAX_VIDEO_BYTES", str(500 * 1024 * 1024)))
+
+# Accepted type (a mime type or a top-level type) and size limit per command
+ATTACHMENT_RULES = {
+    "describe": ("image", "an image", MAX_IMAGE_BYTES),
+    "summarize": ("application/pdf", "a PDF", MAX_PDF_BYTES),
+    "ask_doc": ("application/pdf", "a PDF", MAX_PDF_BYTES),
+    "summarize_audio": ("audio", "an audio file", MAX_AUDIO_BYTES),
+    "describe_video": ("video", "a video", MAX_VIDEO_BYTES),
+}
+
+class AttachmentRejected(Exception):
+    pass
+
+# ISO base media files (MP4, MOV, M4A, HEIC) are told apart by their brand
+FTYP_BRANDS = {
+    b"heic": "image/heic", b"heix": "image/heic", b"mif1": "image/heif", b"msf1": "image/heif",
+    b"M4A ": "audio/mp4", b"M4B ": "audio/mp4", b"qt  ": "video/quicktime",
+    b"3gp4": "video/3gpp", b"3gp5": "video/3gpp", b"3g2a": "video/3gpp2",
+}
+
+def sniff_mime_type(head):
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head.startswith(b"BM") and head[6:10] == b"\x00\x00\x00\x00":
+        return "image/bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    if head.startswith(b"RIFF"):
+        return {b"WEBP": "image/webp", b"WAVE": "audio/wav", b"AVI ": "video/x-msvideo"}.get(head[8:12])
+    if head.startswith(b"FORM") and head[8:12] in (b"AIFF", b"AIFC"):
+        return "audio/aiff"
+    if head[4:8] == b"ftyp":
+        return FTYP_BRANDS.get(head[8:12], "video/mp4")
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "video/webm"
+    if head.startswith(b"OggS"):
+        return "audio/ogg"
+    if head.startswith(b"fLaC"):
+        return "audio/flac"
+    if head.startswith(b"ID3") or head[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "audio/mpeg"
+    if head[:2] in (b"\xff\xf1", b"\xff\xf9"):
+        return "audio/aac"
+    if head.startswith(b"FLV"):
+        return "video/x-flv"
+    if head[:4] in (b"\x00\x00\x01\xba", b"\x00\x00\x01\xb3"):
+        return "video/mpeg"
+    return None
+
+# MP4 files with a generic brand (isom, mp42, ...) and Matroska/WebM files can
+# hold video or audio only, which the header does not tell. For those, an
+# attachment declared as audio (by Discord's content type, or else by its
+# extension) is taken to be audio.
+AUDIO_ONLY_CONTAINERS = {"video/mp4": "audio/mp4", "video/webm": "audio/webm"}
+AUDIO_EXTENSIONS = {".m4a", ".m4b", ".mka", ".weba"}
+
+def declared_audio(attachment):
+    content_type = (attachment.content_type or "").split(";")[0]
+    if content_type.startswith(("audio/", "video/")):
+        return content_type.startswith("audio/")
+    return pathlib.Path(attachment.filename).suffix.lower() in AUDIO_EXTENSIONS
+
+# One HTTP session for all attachment downloads, created on first use
+http = None
+
+def http_session():
+    global http
+    if http is None or http.closed:
+        http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=60))
+    return http
+
+async def close_http_session():
+    if http is not None:
+        await http.close()
+
+async def read_head(url, size=64):
+    async with http_session().get(url, headers={"Range": f"bytes=0-{size - 1}"}) as response:
+        response.raise_for_status()
+        head = b""
+        # The server may ignore the range and send the whole file
+        while len(head) < size:
+            chunk = await response.content.read(size - len(head))
+            if not chunk:
+                break
+            head += chunk
+        return head
+
+# Checks an attachment for the current command and returns its sniffed type
+# and the command's size limit
+async def preflight(attachment, command=None):
+    if command is None:
+        command = request_context.get()["command"]
+    kind, label, limit = ATTACHMENT_RULES[command]
+    if attachment.size > limit:
+        raise AttachmentRejected(
+            f"{attachment.filename} is {attachment.size / 1e6:.1f} MB; the limit is {limit / 1e6:.0f} MB."
+        )
+    with span("preflight"):
+        mime_type = sniff_mime_type(await read_head(attachment.url))
+    if mime_type in AUDIO_ONLY_CONTAINERS and declared_audio(attachment):
+        mime_type = AUDIO_ONLY_CONTAINERS[mime_type]
+    if not (mime_type == kind or (mime_type or "").startswith(kind + "/")):
+        raise AttachmentRejected(f"{attachment.filename} does not look like {label}.")
+    return mime_type, limit
+
+# Streams a download into `write`, giving up once more than `limit` bytes arrived
+async def download(url, write, limit):
+    async with http_session().get(url) as response:
+        response.raise_for_status()
+        if response.content_length is not None and response.content_length > limit:
+            raise AttachmentRejected(f"The file is larger than {limit / 1e6:.0f} MB.")
+        received = 0
+        async for chunk in response.content.iter_chunked(1 << 16):
+            received += len(chunk)
+            if received > limit:
+                raise AttachmentRejected(f"The file is larger than {limit / 1e6:.0f} MB.")
+            write(chunk)
+
+@contextlib.asynccontextmanager
+async def load_attachment(attachment, command=None):
+    if getattr(attachment, "payload", None) is not None:
+        yield attachment.payload
+        return
+    mime_type, limit = await preflight(attachment, command)
+    path = None
+    try:
+        if attachment.size > ATTACHMENT_SPILL_BYTES:
+            fd, name = tempfile.mkstemp(prefix="attachment_", suffix=pathlib.Path(attachment.filename).suffix)
+            path = pathlib.Path(name)
+            with span("download"), open(fd, "wb") as f:
+                await download(attachment.url, f.write, limit)
+            yield AttachmentPayload(attachment.filename, mime_type, path=path)
+        else:
+            data = bytearray()
+            with span("download"):
+                await download(attachment.url, data.extend, limit)
+            yield AttachmentPayload(attachment.filename, mime_type, data=bytes(data))
+    finally:
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+# A path to the attachment for code that only reads files; attachments held
+# in memory are written to a temp file for the duration.
+@contextlib.asynccontextmanager
+async def payload_path(payload):
+    if payload.path is not None:
+        yield payload.path
+        return
+    fd, name = tempfile.mkstemp(prefix="attachment_", suffix=pathlib.Path(payload.filename).suffix)
+    os.close(fd)
+    path = pathlib.Path(name)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, path.write_bytes, payload.data)
+        yield path
+    finally:
+        path.unlink(missing_ok=True)
+
+# Images are downscaled to IMAGE_MAX_DIMENSION, rotated according to their
+# EXIF orientation and re-encoded as IMAGE_FORMAT before being sent to Gemini.
+# The work runs on its own thread pool so decoding never blocks the event loop.
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1536"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "WEBP").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 2)))
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+# Returns the compact image bytes and their mime type
+def preprocess_image(data, max_dimension=IMAGE_MAX_DIMENSION, fmt=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    image = Image.open(io.BytesIO(data))
+    original_format = image.format
+    if original_format == "JPEG":
+        # Let the JPEG decoder work at a reduced scale instead of full resolution
+        image.draft("RGB", (max_dimension, max_dimension))
+    rotated = image.getexif().get(0x0112, 1) != 1  # EXIF Orientation tag
+    image = ImageOps.exif_transpose(image)
+    resized = max(image.size) > max_dimension
+    if resized:
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    if fmt == "JPEG" or image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if fmt != "JPEG" and "A" in image.getbands() else "RGB")
+    out = io.BytesIO()
+    image.save(out, format=fmt, quality=quality)
+    encoded = out.getvalue()
+    # Images that needed no changes and are already compact are sent untouched
+    if (not resized and not rotated and len(data) <= len(encoded)
+            and original_format in ("JPEG", "PNG", "WEBP")):
+        return data, Image.MIME[original_format]
+    return encoded, Image.MIME[fmt]
+
+async def prepare_image(payload):
+    loop = asyncio.get_running_loop()
+    with span("preprocess"):
+        data, mime_type = await loop.run_in_executor(image_executor, preprocess_image, payload.read())
+    return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+def upload_payload(payload):
+    with payload.open() as f:
+        return client_gemini.files.upload(
+            file=f,
+            config=types.UploadFileConfig(mime_type=payload.mime_type, display_name=payload.filename),
+        )
+
+def file_content(file_upload):
+    return types.Content(
+        role="user",
+        parts=[types.Part.from_uri(file_uri=file_upload.uri, mime_type=file_upload.mime_type)],
+    )
+
+# Upload an attachment to Gemini, reusing an earlier upload of identical bytes.
+# Returns the file handle and the content digest it was cached under.
+async def upload_file(payload):
+    digest = await payload.digest()
+    file_upload = await upload_cache.get(digest)
+    if file_upload is None:
+        with span("upload"):
+            file_upload = await run_gemini(upload_payload, payload)
+        await upload_cache.put(digest, file_upload)
+    return file_upload, digest
+
+# Runs use(file_upload, digest) on the uploaded attachment. A cached upload can
+# disappear on Google's side before its recorded expiry; if the call is refused
+# with 403/404, the cache entry is dropped and the file is uploaded once more.
+async def with_upload(payload, use):
+    digest = await payload.digest()
+    cached = await upload_cache.get(digest) is not None
+    file_upload, digest = await upload_file(payload)
+    try:
+        return await use(file_upload, digest)
+    except errors.ClientError as e:
+        if not cached or e.code not in (403, 404):
+            raise
+        log.info("Cached upload %s is gone (%s), uploading again", file_upload.name, e.code)
+        await upload_cache.discard(digest)
+        file_upload, digest = await upload_file(payload)
+        return await use(file_upload, digest)
+
+# Keeps one Gemini chat session per (guild, channel, user) so /chat remembers
+# the conversation. History is trimmed to CHAT_HISTORY_TOKENS (estimated at
+# four characters per token) by dropping the oldest turns, and sessions are
+# evicted after CHAT_IDLE_TIMEOUT seconds of inactivity or when more than
+# CHAT_MAX_SESSIONS are open (least recently used first).
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "8000"))
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "1000"))
+CHAT_IDLE_TIMEOUT = float(os.getenv("CHAT_IDLE_TIMEOUT", "1800"))
+
+def estimate_tokens(content):
+    return sum(len(part.text or "") for part in content.parts or []) // 4 + 1
+
+class ChatSessionManager:
+    def __init__(self, max_sessions=CHAT_MAX_SESSIONS, idle_timeout=CHAT_IDLE_TIMEOUT,
+                 history_tokens=CHAT_HISTORY_TOKENS):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.history_tokens = history_tokens
+        self.sessions = OrderedDict()  # key -> {"chat", "lock", "last_used"}
+
+    def create(self, history=None):
+        return client_gemini.chats.create(
+            model=MODEL_ID, config=types.GenerateContentConfig(temperature=0.5), history=history
+        )
+
+    def evict(self, now):
+        for key, entry in list(self.sessions.items()):
+            if now - entry["last_used"] > self.idle_timeout and not entry["lock"].locked():
+                del self.sessions[key]
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def trim(self, chat_session):
+        history = chat_session.get_history()
+        tokens = sum(estimate_tokens(content) for content in history)
+        if tokens <= self.history_tokens:
+            return chat_session
+        while history and tokens > self.history_tokens:
+            tokens -= estimate_tokens(history.pop(0))
+        # The remaining history has to start with a user turn
+        while history and history[0].role != "user":
+            history.pop(0)
+        return self.create(history)
+
+    # Hold the session for one exchange; messages to the same session are
+    # serialized so turns never interleave.
+    @contextlib.asynccontextmanager
+    async def session(self, key):
+        now = time.time()
+        entry = self.sessions.get(key)
+        if entry is None:
+            entry = {"chat": self.create(), "lock": asyncio.Lock(), "last_used": now}
+            self.sessions[key] = entry
+        self.sessions.move_to_end(key)
+        self.evict(now)
+        async with entry["lock"]:
+            entry["chat"] = self.trim(entry["chat"])
+            try:
+                yield entry["chat"]
+            finally:
+                entry["last_used"] = time.time()
+
+chat_sessions = ChatSessionManager()
+
+# /ask_doc keeps the PDF a channel is asking about in a Gemini context cache,
+# so follow-up questions send only the question. A cache lives for
+# DOC_CACHE_TTL seconds on Gemini's side and is extended while it is in use;
+# it is deleted once the channel has not asked about the document for
+# DOC_IDLE_TIMEOUT seconds. Documents too small to be cached are sent along
+# with every question instead. Context caching needs a stable model version,
+# DOC_MODEL_ID.
+DOC_MODEL_ID = os.getenv("DOC_MODEL_ID", "gemini-2.0-flash-001")
+DOC_CACHE_TTL = int(os.getenv("DOC_CACHE_TTL", "3600"))
+DOC_IDLE_TIMEOUT = int(os.getenv("DOC_IDLE_TIMEOUT", "900"))
+
+# Gemini refuses to cache content below a minimum size with a 400 like "Cached
+# content is too small. total_token_count=900, min_total_token_count=4096"
+def too_small_to_cache(error):
+    message = (error.message or "").lower()
+    return error.code == 400 and ("min_total_token_count" in message or "too small" in message)
+
+class DocumentCacheManager:
+    def __init__(self, ttl=DOC_CACHE_TTL, idle_timeout=DOC_IDLE_TIMEOUT):
+        self.ttl = ttl
+        self.idle_timeout = idle_timeout
+        self.documents = {}  # channel id -> {"filename", "cache", "file", "expires", "last_used"}
+        self.sweeper = None
+
+    def start(self):
+        if self.sweeper is None:
+            self.sweeper = asyncio.create_task(self.sweep_forever())
+
+    async def bind(self, key, filename, file_upload):
+        try:
+            cache = await run_gemini(
+                client_gemini.caches.create,
+                model=DOC_MODEL_ID,
+                config=types.CreateCachedContentConfig(
+                    contents=[file_content(file_upload)], ttl=f"{self.ttl}s", display_name=filename[:128],
+                ),
+            )
+        except errors.ClientError as e:
+            if not too_small_to_cache(e):
+                raise
+            log.info("Not caching %s: %s", filename, e)
+            cache = None
+        await self.drop(key)
+        now = time.time()
+        self.documents[key] = {
+            "filename": filename,
+            "cache": cache.name if cache is not None else None,
+            "file": file_upload,
+            "expires": now + self.ttl,
+            "last_used": now,
+        }
+
+    # The document bound to a channel, with its cache extended if it is past
+    # half of its lifetime
+    async def get(self, key):
+        entry = self.documents.get(key)
+        if entry is None:
+            return None
+        now = time.time()
+        entry["last_used"] = now
+        if entry["cache"] is not None and entry["expires"] - now < self.ttl / 2:
+            await run_gemini(
+                client_gemini.caches.update,
+                name=entry["cache"],
+                config=types.UpdateCachedContentConfig(ttl=f"{self.ttl}s"),
+            )
+            entry["expires"] = now + self.ttl
+        return entry
+
+    async def drop(self, key):
+        entry = self.documents.pop(key, None)
+        if entry is None or entry["cache"] is None:
+            return
+        try:
+            await run_gemini(client_gemini.caches.delete, name=entry["cache"])
+        except Exception as e:
+            log.warning("Could not delete context cache %s: %s", entry["cache"], e)
+
+    async def sweep(self):
+        now = time.time()
+        for key, entry in list(self.documents.items()):
+            if now - entry["last_used"] > self.idle_timeout:
+                await self.drop(key)
+
+    async def sweep_forever(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            await self.sweep()
+
+document_caches = DocumentCacheManager()
+
+# Slash commands take their file as an option; prefix commands use the
+# attachments of the invoking message.
+def command_attachments(ctx, attachment):
+    if ctx.interaction is None:
+        return ctx.message.attachments
+    return [attachment] if attachment is not None else []
+
+# 包裝 send 方法，印出訊息內容
+async def safe_send(ctx, content, **kwargs):
+    if log_body():
+        log.info("Bot Sending: %s", Truncated(content))
+    with span("send"):
+        return await ctx.send(content, **kwargs)
 
 # Event: 捕捉每次接收到的訊息
 @bot.event
 async def on_message(message):
     if message.author == bot.user:  # 避免處理自己的訊息
         return
-    print(f"Message Received: {message.content} (from {message.author})")
+    if log_body():
+        log.info("Message Received: %s (from %s)", Truncated(message.content), message.author)
     await bot.process_commands(message)
 
-# Command: Ask a question
-@bot.command(description="Ask a question to the AI.")
-async def ask(ctx, *, question):
-    await safe_send(ctx, f"\ud83d\udca1 Thinking about your question...")
-    response = client_gemini.models.generate_content(
-        model=MODEL_ID, contents=question
+# Long PDFs are summarized map-reduce style: their text is extracted page by
+# page on a pool of PDF_WORKERS processes (PDF_PAGES_PER_TASK pages per task),
+# packed into chunks of at most PDF_CHUNK_TOKENS that are summarized
+# concurrently (PDF_MAP_CONCURRENCY at a time), and the partial summaries are
+# merged by a final request. PDFs under PDF_MAP_REDUCE_PAGES pages, PDFs with
+# less than PDF_MIN_CHARS_PER_PAGE characters of text per page (scans) and
+# all PDFs when the optional pypdf package is missing are uploaded whole.
+PDF_MAP_REDUCE_PAGES = int(os.getenv("PDF_MAP_REDUCE_PAGES", "50"))
+PDF_CHUNK_TOKENS = int(os.getenv("PDF_CHUNK_TOKENS", "30000"))
+PDF_MIN_CHARS_PER_PAGE = int(os.getenv("PDF_MIN_CHARS_PER_PAGE", "200"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "25"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 2)))
+PDF_MAP_CONCURRENCY = int(os.getenv("PDF_MAP_CONCURRENCY", "8"))
+HAVE_PYPDF = importlib.util.find_spec("pypdf") is not None
+pdf_executor = None
+
+PDF_PROMPT = "Summarize this PDF as bullet points."
+PDF_MERGE_PROMPT = (
+    "These are summaries of consecutive parts of one PDF. Merge them into a single "
+    "bullet-point summary of the whole document."
+)
+
+# These run in the worker processes
+def pdf_page_count(path):
+    import pypdf
+    return len(pypdf.PdfReader(path).pages)
+
+def extract_pdf_pages(path, start, stop):
+    import pypdf
+    reader = pypdf.PdfReader(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+async def in_pdf_pool(func, *args):
+    global pdf_executor
+    if pdf_executor is None:
+        pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    return await asyncio.get_running_loop().run_in_executor(pdf_executor, func, *args)
+
+# The text of every page, or None when the PDF should be uploaded whole
+async def extract_pdf_text(payload):
+    try:
+        # The workers read the file themselves instead of each being sent a copy
+        async with payload_path(payload) as path:
+            pages = await in_pdf_pool(pdf_page_count, str(path))
+            if pages < PDF_MAP_REDUCE_PAGES:
+                return None
+            batches = await asyncio.gather(*(
+                in_pdf_pool(extract_pdf_pages, str(path), start, min(start + PDF_PAGES_PER_TASK, pages))
+                for start in range(0, pages, PDF_PAGES_PER_TASK)
+            ))
+    except Exception as e:
+        log.warning("Could not extract the text of %s: %s", payload.filename, e)
+        return None
+    texts = [text.strip() for batch in batches for text in batch]
+    if sum(len(text) for text in texts) < PDF_MIN_CHARS_PER_PAGE * pages:
+        return None
+    return texts
+
+# Packs pages (or partial summaries) into chunks of at most PDF_CHUNK_TOKENS,
+# estimated at four characters per token. Returns (first, last, text) tuples
+# with 1-based item numbers.
+def pack_chunks(texts, labels=None):
+    budget = PDF_CHUNK_TOKENS * 4
+    chunks = []
+    for number, text in enumerate(texts, 1):
+        item = f"[{labels[number - 1] if labels else f'Page {number}'}]\n{text}\n"
+        if chunks and len(chunks[-1][2]) + len(item) <= budget:
+            first, _, body = chunks[-1]
+            chunks[-1] = (first, number, body + item)
+        else:
+            chunks.append((number, number, item))
+    return chunks
+
+# Summarizes a PDF by passing generate() the request for it: the whole file, or
+# for long PDFs the merged partial summaries of its chunks
+async def summarize_pdf(payload, generate, placeholder=None):
+    texts = None
+    if HAVE_PYPDF:
+        with span("extract"):
+            texts = await extract_pdf_text(payload)
+    if texts is None:
+        return await with_upload(payload, lambda file_upload, _: generate([file_content(file_upload), PDF_PROMPT]))
+
+    semaphore = asyncio.Semaphore(PDF_MAP_CONCURRENCY)
+
+    async def summarize_chunk(first, last, text, prompt):
+        async with semaphore:
+            return await generate_text([text, prompt.format(first=first, last=last)])
+
+    chunks = pack_chunks(texts)
+    if placeholder is not None:
+        await placeholder.edit(content=f"\ud83d\udcc4 Analyzing PDF ({len(texts)} pages in {len(chunks)} parts)...")
+    partials = await asyncio.gather(*(
+        summarize_chunk(first, last, text, "Summarize pages {first} to {last} of this PDF as bullet "
+                        "points, keeping key facts, figures and names.")
+        for first, last, text in chunks
+    ))
+    pages = [(first, last) for first, last, _ in chunks]
+    # Merge in rounds until the partial summaries fit in a single request
+    while len(partials) > 1 and sum(len(partial) for partial in partials) > PDF_CHUNK_TOKENS * 4:
+        groups = pack_chunks(partials, [f"Pages {first}-{last}" for first, last in pages])
+        if len(groups) == len(partials):
+            break
+        partials = await asyncio.gather(*(
+            summarize_chunk(pages[first - 1][0], pages[last - 1][1], text, PDF_MERGE_PROMPT)
+            for first, last, text in groups
+        ))
+        pages = [(pages[first - 1][0], pages[last - 1][1]) for first, last, _ in groups]
+    return await generate([
+        "\n\n".join(f"[Pages {first}-{last}]\n{partial}" for (first, last), partial in zip(pages, partials)),
+        PDF_MERGE_PROMPT,
+    ])
+
+# Messages with several attachments are processed as one batch: items run
+# concurrently (at most BATCH_CONCURRENCY per message) and the results are
+# posted as a single reply in attachment order. Images are packed into
+# multi-image requests of at most IMAGE_PACK_LIMIT images each (split into
+# groups of even size) instead of one request each.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+IMAGE_PACK_LIMIT = int(os.getenv("IMAGE_PACK_LIMIT", "8"))
+
+# Describe several images with one request. Returns None when the answer
+# cannot be split back into one description per image.
+async def describe_packed(parts):
+    prompt = (
+        f"Describe each of these {len(parts)} images separately. Start the description "
+        "of image k with a line containing only '### Image k'."
     )
-    full_response = response.candidates[0].content.parts[0].text
-    await send_long_message(ctx, "**Answer:** ", full_response)
+    text = await generate_text(parts + [prompt])
+    sections = re.split(r"^\s*#+\s*Image\s+(\d+)\s*$", text or "", flags=re.M)
+    found = {int(number): body.strip() for number, body in zip(sections[1::2], sections[2::2])}
+    if sorted(found) != list(range(1, len(parts) + 1)) or not all(found.values()):
+        return None
+    return [found[k] for k in range(1, len(parts) + 1)]
 
-# Command: Upload an image and describe it
-@bot.command(description="Upload an image and have it described by the AI.")
-async def describe(ctx):
-    if ctx.message.attachments:
-        attachment = ctx.message.attachments[0]
-        img_path = pathlib.Path(f"temp_{attachment.filename}")
-        await attachment.save(img_path)
-        image = Image.open(img_path)
-        await safe_send(ctx, "\ud83d\uddbc Processing image...")
-        response = client_gemini.models.generate_content(
-            model=MODEL_ID,
-            contents=[image, "Describe this image."],
+async def describe_batch(ctx, attachments):
+    placeholder = await safe_send(ctx, f"\ud83d\uddbc Processing {len(attachments)} images...")
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def load(attachment):
+        async with semaphore:
+            async with load_attachment(attachment) as payload:
+                digest = await payload.digest()
+                cache_key = response_cache.key("describe", MODEL_ID, "Describe this image.", digest)
+                cached = await response_cache.get(cache_key)
+                image = await prepare_image(payload) if cached is None else None
+                return cache_key, cached, image
+
+    items = await asyncio.gather(*(load(attachment) for attachment in attachments))
+    results = [cached for _, cached, _ in items]
+    missing = [i for i, result in enumerate(results) if result is None]
+    count = -(-len(missing) // max(1, IMAGE_PACK_LIMIT))
+    groups = [missing[len(missing) * k // count:len(missing) * (k + 1) // count] for k in range(count)]
+
+    async def describe_group(group):
+        async with semaphore:
+            packed = await describe_packed([items[i][2] for i in group])
+        if packed is not None:
+            for i, description in zip(group, packed):
+                results[i] = description
+
+    await asyncio.gather(*(describe_group(group) for group in groups if len(group) > 1))
+
+    async def describe_one(i):
+        async with semaphore:
+            results[i] = await generate_text([items[i][2], "Describe this image."])
+
+    await asyncio.gather(*(describe_one(i) for i in missing if results[i] is None))
+    for i in missing:
+        if results[i]:
+            await response_cache.put(items[i][0], results[i])
+    await send_long_message(ctx, "", "\n\n".join(
+        f"**Description of {attachment.filename}:** {result}"
+        for attachment, result in zip(attachments, results)
+    ), placeholder)
+
+async def summarize_batch(ctx, attachments):
+    placeholder = await safe_send(ctx, f"\ud83d\udcc4 Analyzing {len(attachments)} PDFs...")
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def summarize_one(attachment):
+        async with semaphore:
+            async with load_attachment(attachment) as payload:
+                return await summarize_pdf(payload, generate_text)
+
+    results = await asyncio.gather(*(summarize_one(attachment) for attachment in attachments))
+    await send_long_message(ctx, "", "\n\n".join(
+        f"**Summary of {attachment.filename}:**\n{result}"
+        for attachment, result in zip(attachments, results)
+    ), placeholder)
+
+# What to tell the user about a rejected attachment or a failed Gemini call, or
+# None for other errors
+def error_message(error):
+    if isinstance(error, AttachmentRejected):
+        return f"\ud83d\ude14 {error}"
+    if isinstance(error, GeminiUnavailable):
+        return "\ud83d\ude14 The AI service is unavailable right now, please try again in a minute."
+    if isinstance(error, (errors.APIError, asyncio.TimeoutError)):
+        return "\ud83d\ude14 The AI request failed, please try again."
+    return None
+
+# WAV recordings are converted to AUDIO_SAMPLE_RATE Hz 16-bit mono before
+# upload (usually several times smaller, with no loss that matters for speech),
+# in blocks on a worker thread. Recordings longer than AUDIO_SEGMENT_SECONDS are
+# cut into segments overlapping by AUDIO_SEGMENT_OVERLAP seconds, which are
+# summarized concurrently (AUDIO_SEGMENT_CONCURRENCY at a time) and then
+# merged. This needs the optional numpy package; other formats, and all audio
+# without numpy, are uploaded as they are.
+AUDIO_SAMPLE_RATE = int(os.getenv("AUDIO_SAMPLE_RATE", "16000"))
+AUDIO_SEGMENT_SECONDS = int(os.getenv("AUDIO_SEGMENT_SECONDS", "600"))
+AUDIO_SEGMENT_OVERLAP = int(os.getenv("AUDIO_SEGMENT_OVERLAP", "10"))
+AUDIO_SEGMENT_CONCURRENCY = int(os.getenv("AUDIO_SEGMENT_CONCURRENCY", "4"))
+HAVE_NUMPY = importlib.util.find_spec("numpy") is not None
+WAV_MIME_TYPES = ("audio/wav", "audio/x-wav", "audio/wave")
+
+AUDIO_PROMPT = "Listen carefully to the following audio file. Provide a brief summary."
+AUDIO_MERGE_PROMPT = (
+    "These are summaries of consecutive, slightly overlapping parts of one recording. "
+    "Merge them into a single brief summary of the whole recording."
+)
+
+# PCM samples of any WAV sample width as floats on the 16-bit scale
+def pcm_samples(raw, width):
+    import numpy as np
+    if width == 1:
+        return (np.frombuffer(raw, np.uint8).astype(np.float32) - 128) * 256
+    if width == 2:
+        return np.frombuffer(raw, "<i2").astype(np.float32)
+    if width == 3:
+        b = np.frombuffer(raw, np.uint8).reshape(-1, 3).astype(np.int32)
+        return ((b[:, 0] | b[:, 1] << 8 | b[:, 2] << 16) << 8 >> 8).astype(np.float32) / 256
+    return np.frombuffer(raw, "<i4").astype(np.float32) / 65536
+
+# Downmixes and resamples a WAV file to 16-bit mono at `rate` Hz (or at its own
+# rate, if lower). A moving average over one output sample period filters out
+# what would alias, and linear interpolation picks the output samples. Returns
+# the PCM data and its rate, or None for files the wave module cannot read
+# (compressed WAVs) and files that would not get smaller.
+def transcode_wav(source, rate=AUDIO_SAMPLE_RATE, block_seconds=30):
+    import numpy as np
+    try:
+        wav = wave.open(source, "rb")
+    except (wave.Error, EOFError):
+        return None
+    with wav:
+        channels, width, in_rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+        rate = min(rate, in_rate)
+        if rate * 2 >= in_rate * channels * width:
+            return None
+        step = in_rate / rate
+        kernel = np.ones(max(1, int(step)), np.float32) / max(1, int(step))
+        out = io.BytesIO()
+        tail = np.zeros(0, np.float32)
+        position = 0  # input index of the first frame of the block
+        next_out = 0.0  # input position of the next output sample
+        while True:
+            raw = wav.readframes(in_rate * block_seconds)
+            if not raw:
+                break
+            mono = pcm_samples(raw, width).reshape(-1, channels).mean(axis=1)
+            signal = np.concatenate((tail, mono))
+            start = position - len(tail)
+            if len(kernel) > 1:
+                signal = np.convolve(signal, kernel, "valid")
+                start += len(kernel) - 1
+            last = start + len(signal) - 1
+            if last >= next_out:
+                positions = np.arange(next_out, last + 1e-9, step)
+                values = np.interp(positions, np.arange(start, last + 1), signal)
+                out.write(np.clip(np.round(values), -32768, 32767).astype("<i2").tobytes())
+                next_out = positions[-1] + step
+            position += len(mono)
+            tail = np.concatenate((tail, mono))[-len(kernel):]
+        return out.getvalue(), rate
+
+def wav_bytes(pcm, rate=AUDIO_SAMPLE_RATE):
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm)
+    return out.getvalue()
+
+# The transcoded recording as (start second, end second, WAV bytes) segments,
+# or None when it is sent as uploaded
+def audio_segments(payload, rate=AUDIO_SAMPLE_RATE):
+    with payload.open() as source:
+        transcoded = transcode_wav(source, rate)
+    if transcoded is None:
+        return None
+    pcm, rate = transcoded
+    frames = len(pcm) // 2
+    length, overlap = AUDIO_SEGMENT_SECONDS * rate, AUDIO_SEGMENT_OVERLAP * rate
+    segments = []
+    start = 0
+    while True:
+        end = min(frames, start + length)
+        segments.append((start // rate, end // rate, wav_bytes(pcm[start * 2:end * 2], rate)))
+        if end >= frames:
+            return segments
+        start = end - overlap
+
+# Short videos take a fast path: when the optional OpenCV package (cv2) is
+# installed, videos up to VIDEO_FAST_MAX_BYTES are decoded locally right away,
+# and if they last at most VIDEO_FAST_MAX_SECONDS, up to VIDEO_KEYFRAMES frames
+# are sent as one multi-image request, skipping the Files API upload and
+# processing wait. Frames are sampled VIDEO_SAMPLE_FPS times a second; those
+# whose color histogram differs from the previous sample by at least
+# VIDEO_SCENE_THRESHOLD (Bhattacharyya distance) mark scene changes and are
+# preferred, the rest is filled with evenly spaced frames. Longer videos are
+# queued as jobs as before.
+VIDEO_FAST_MAX_BYTES = int(os.getenv("VIDEO_FAST_MAX_BYTES", str(20 * 1024 * 1024)))
+VIDEO_FAST_MAX_SECONDS = float(os.getenv("VIDEO_FAST_MAX_SECONDS", "60"))
+VIDEO_KEYFRAMES = int(os.getenv("VIDEO_KEYFRAMES", "8"))
+VIDEO_SAMPLE_FPS = float(os.getenv("VIDEO_SAMPLE_FPS", "2"))
+VIDEO_SCENE_THRESHOLD = float(os.getenv("VIDEO_SCENE_THRESHOLD", "0.3"))
+VIDEO_FRAME_DIMENSION = int(os.getenv("VIDEO_FRAME_DIMENSION", "768"))
+HAVE_CV2 = importlib.util.find_spec("cv2") is not None
+
+# Picks up to `count` of the sampled frames from their scene change scores: the
+# strongest scene changes first, then evenly spaced frames. Returns their
+# indices in order.
+def pick_keyframes(scores, count=VIDEO_KEYFRAMES, threshold=VIDEO_SCENE_THRESHOLD):
+    scenes = sorted((i for i, score in enumerate(scores) if score >= threshold), key=lambda i: -scores[i])
+    chosen = set(scenes[:count])
+    for k in range(count):
+        if len(chosen) >= min(count, len(scores)):
+            break
+        chosen.add(round(k * (len(scores) - 1) / max(1, count - 1)))
+    return sorted(chosen)
+
+# Returns the duration and a list of (second, JPEG bytes) keyframes, or None
+# when the video is too long or cannot be decoded
+def video_keyframes(path, count=VIDEO_KEYFRAMES, max_seconds=VIDEO_FAST_MAX_SECONDS):
+    import cv2
+    capture = cv2.VideoCapture(str(path))
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) if capture.isOpened() else 0
+        frames = capture.get(cv2.CAP_PROP_FRAME_COUNT) if fps > 0 else 0
+        if frames <= 0 or frames / fps > max_seconds:
+            return None
+        stride = max(1, round(fps / VIDEO_SAMPLE_FPS))
+        samples = []  # (second, scene change score, JPEG bytes)
+        previous = None
+        index = 0
+        while capture.grab():
+            if index % stride == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                small = cv2.cvtColor(cv2.resize(frame, (64, 64), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2HSV)
+                histogram = cv2.calcHist([small], [0, 1], None, [16, 16], [0, 180, 0, 256])
+                cv2.normalize(histogram, histogram)
+                score = 1.0 if previous is None else cv2.compareHist(previous, histogram, cv2.HISTCMP_BHATTACHARYYA)
+                previous = histogram
+                height, width = frame.shape[:2]
+                scale = min(1.0, VIDEO_FRAME_DIMENSION / max(height, width))
+                if scale < 1:
+                    frame = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+                ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, IMAGE_QUALITY])
+                if ok:
+                    samples.append((index / fps, score, encoded.tobytes()))
+            index += 1
+    finally:
+        capture.release()
+    if not samples:
+        return None
+    chosen = pick_keyframes([score for _, score, _ in samples], count)
+    return index / fps, [(samples[i][0], samples[i][2]) for i in chosen]
+
+# The request describing a short video from its keyframes, or None when the
+# video has to go through the Files API
+async def video_keyframe_contents(payload):
+    async with payload_path(payload) as path:
+        with span("preprocess"):
+            result = await asyncio.get_running_loop().run_in_executor(image_executor, video_keyframes, path)
+    if result is None:
+        return None
+    duration, keyframes = result
+    contents = []
+    for second, data in keyframes:
+        contents.append(f"Frame at {second:.1f}s:")
+        contents.append(types.Part.from_bytes(data=data, mime_type="image/jpeg"))
+    contents.append(
+        f"These are {len(keyframes)} frames, in order, from a {duration:.0f}-second video. Describe this video."
+    )
+    return contents
+
+# /describe_video and /summarize_audio run as background jobs: the command
+# only records the job and replies with its ID, and JOB_WORKERS workers
+# download, upload and analyze the files and post the results to the channel.
+# Jobs are stored in JOBS_PATH, so queued and interrupted jobs are picked up
+# again after a restart.
+JOBS_PATH = os.getenv("JOBS_PATH", "jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+class JobFailed(Exception):
+    pass
+
+# The attachment of a recovered job; load_attachment downloads it again by URL.
+# A job queued after the command already downloaded the file carries that
+# payload instead, as long as the process runs.
+class StoredAttachment:
+    def __init__(self, filename, content_type, size, url, payload=None):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.url = url
+        self.payload = payload
+
+async def describe_video_job(attachment):
+    async def describe(file_upload, digest):
+        # Wait for video processing to complete
+        if file_upload.state != "ACTIVE":
+            with span("poll"):
+                file_upload = await file_poller.wait(file_upload)
+        if file_upload.state == "FAILED":
+            await upload_cache.discard(digest)
+            raise JobFailed("Video processing failed.")
+        return await generate_text([file_content(file_upload), "Describe this video."])
+
+    async with load_attachment(attachment) as payload:
+        full_response = await with_upload(payload, describe)
+
+    # Log to terminal
+    log.info("Video Description: %s", Truncated(full_response))
+    return full_response
+
+async def summarize_audio_job(attachment):
+    async with load_attachment(attachment) as payload:
+        segments = None
+        if HAVE_NUMPY and payload.mime_type in WAV_MIME_TYPES:
+            with span("preprocess"):
+                segments = await asyncio.get_running_loop().run_in_executor(None, audio_segments, payload)
+        if segments is None:
+            return await with_upload(payload, lambda file_upload, _: generate_text([file_content(file_upload), AUDIO_PROMPT]))
+    stem = pathlib.Path(attachment.filename).stem
+    semaphore = asyncio.Semaphore(AUDIO_SEGMENT_CONCURRENCY)
+
+    async def summarize_segment(number, start, end, data):
+        prompt = AUDIO_PROMPT
+        if len(segments) > 1:
+            prompt = (
+                f"This is part {number} of {len(segments)} of a longer recording, from "
+                f"{start // 60}:{start % 60:02d} to {end // 60}:{end % 60:02d}. {AUDIO_PROMPT}"
+            )
+        async with semaphore:
+            return await with_upload(
+                AttachmentPayload(f"{stem}.part{number}.wav", "audio/wav", data=data),
+                lambda file_upload, _: generate_text([file_content(file_upload), prompt]),
+            )
+
+    summaries = await asyncio.gather(*(
+        summarize_segment(number, *segment) for number, segment in enumerate(segments, 1)
+    ))
+    if len(summaries) == 1:
+        return summaries[0]
+    return await generate_text([
+        "\n\n".join(
+            f"[{start // 60}:{start % 60:02d}-{end // 60}:{end % 60:02d}]\n{summary}"
+            for (start, end, _), summary in zip(segments, summaries)
+        ),
+        AUDIO_MERGE_PROMPT,
+    ])
+
+JOB_COMMANDS = {
+    "describe_video": ("Video Description", describe_video_job),
+    "summarize_audio": ("Audio Summary", summarize_audio_job),
+}
+
+# With several shard processes sharing JOBS_PATH, each one recovers only the
+# jobs of the guilds on its own shards.
+def owns_guild(guild_id):
+    shard_ids = getattr(bot, "shard_ids", None)
+    if shard_ids is None or not bot.shard_count:
+        return True
+    return ((guild_id or 0) >> 22) % bot.shard_count in shard_ids
+
+class JobQueue:
+    def __init__(self, path, workers=JOB_WORKERS):
+        self.db = open_db(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, command TEXT, "
+            "guild INTEGER, channel INTEGER, user INTEGER, filename TEXT, content_type TEXT, "
+            "size INTEGER, url TEXT, state TEXT, result TEXT, error TEXT, created REAL, updated REAL)"
         )
-        full_response = response.candidates[0].content.parts[0].text
-        await send_long_message(ctx, "**Description:** ", full_response)
-        img_path.unlink()
+        self.db.commit()
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+        # Channel and attachment of the jobs submitted by this process, so they
+        # need not be fetched again
+        self.pending = {}
+
+    def start(self):
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue()
+        rows = self.db.execute(
+            "SELECT id, guild FROM jobs WHERE state IN ('queued', 'running') ORDER BY id"
+        ).fetchall()
+        for job_id, guild in rows:
+            if owns_guild(guild):
+                self.write(job_id, state="queued")
+                self.queue.put_nowait(job_id)
+        if rows:
+            log.info("Recovered %d unfinished jobs", self.queue.qsize())
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def submit(self, ctx, attachment):
+        now = time.time()
+
+        def insert():
+            with self.db:
+                return self.db.execute(
+                    "INSERT INTO jobs (command, guild, channel, user, filename, content_type, size, url, "
+                    "state, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                    (ctx.command.name, ctx.guild.id if ctx.guild else None, ctx.channel.id, ctx.author.id,
+                     attachment.filename, attachment.content_type, attachment.size, attachment.url, now, now),
+                ).lastrowid
+
+        job_id = await in_db_thread(insert)
+        self.pending[job_id] = (ctx.channel, attachment)
+        self.queue.put_nowait(job_id)
+        return job_id
+
+    async def update(self, job_id, **fields):
+        await in_db_thread(self.write, job_id, **fields)
+
+    def write(self, job_id, **fields):
+        fields["updated"] = time.time()
+        with self.db:
+            self.db.execute(
+                f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+                (*fields.values(), job_id),
+            )
+
+    async def recent(self, channel_id, limit=10):
+        return await in_db_thread(lambda: self.db.execute(
+            "SELECT id, command, filename, state, error, created FROM jobs WHERE channel = ? "
+            "ORDER BY id DESC LIMIT ?",
+            (channel_id, limit),
+        ).fetchall())
+
+    async def work(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self.run(job_id)
+            except Exception:
+                log.exception("Job %d could not be delivered", job_id)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job_id):
+        command, guild, channel_id, user, filename, content_type, size, url, created = await in_db_thread(
+            lambda: self.db.execute(
+                "SELECT command, guild, channel, user, filename, content_type, size, url, created "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        )
+        channel, attachment = self.pending.pop(job_id, (None, None))
+        if channel is None:
+            try:
+                channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+            except Exception as error:
+                # Deleted, or the bot lost access: nobody is left to post the result to
+                log.warning("Job %d: channel %d is unavailable (%s)", job_id, channel_id, error)
+                await self.update(job_id, state="failed", error=f"Channel unavailable: {error}")
+                return
+            attachment = StoredAttachment(filename, content_type, size, url)
+        title, handler = JOB_COMMANDS[command]
+        request_context.set({
+            "command": command,
+            "lane": COMMAND_LANES.get(command, 0),
+            "guild": guild,
+            "user": user,
+            "started": time.perf_counter(),
+        })
+        observe("job_wait", max(0.0, time.time() - created))
+        await self.update(job_id, state="running")
+        try:
+            with span("job"):
+                result = await handler(attachment)
+        except Exception as error:
+            await self.update(job_id, state="failed", error=str(error))
+            if isinstance(error, JobFailed):
+                message = f"\ud83d\ude14 {error}"
+            else:
+                log.exception("Job %d failed", job_id)
+                message = error_message(error) or "\ud83d\ude14 Something went wrong."
+            await safe_send(channel, f"<@{user}> Job #{job_id} ({filename}) failed. {message}")
+            return
+        await self.update(job_id, state="done", result=result)
+        await send_long_message(channel, f"<@{user}> **{title}** (job #{job_id}): ", result)
+
+job_queue = JobQueue(JOBS_PATH)
+
+# Command: Ask a question
+@bot.hybrid_command(description="Ask a question to the AI.")
+@app_commands.describe(question="What you want to ask")
+async def ask(ctx, *, question: str):
+    cache_key = response_cache.key("ask", MODEL_ID, question)
+    full_response = await response_cache.get(cache_key)
+    if full_response is None:
+        placeholder = await safe_send(ctx, f"\ud83d\udca1 Thinking about your question...")
+
+        async def answer():
+            # An identical request may have finished while the placeholder was sent
+            full_response = await response_cache.get(cache_key)
+            if full_response is not None:
+                await send_long_message(ctx, "**Answer:** ", full_response, placeholder)
+                return full_response
+            full_response = await generate_reply(ctx, "**Answer:** ", question, placeholder=placeholder)
+            if full_response:
+                await response_cache.put(cache_key, full_response)
+            return full_response
+
+        full_response, leader = await single_flight.run(cache_key, answer)
+        if not leader:
+            await send_long_message(ctx, "**Answer:** ", full_response, placeholder)
+    else:
+        await send_long_message(ctx, "**Answer:** ", full_response)
+
+# Command: Upload an image and describe it
+@bot.hybrid_command(description="Upload an image and have it described by the AI.")
+@app_commands.describe(image="The image to describe")
+async def describe(ctx, image: Optional[discord.Attachment] = None):
+    attachments = command_attachments(ctx, image)
+    if len(attachments) > 1:
+        await describe_batch(ctx, attachments)
+    elif attachments:
+        async with load_attachment(attachments[0]) as payload:
+            digest = await payload.digest()
+            cache_key = response_cache.key("describe", MODEL_ID, "Describe this image.", digest)
+            full_response = await response_cache.get(cache_key)
+            if full_response is None:
+                placeholder = await safe_send(ctx, "\ud83d\uddbc Processing image...")
+
+                async def answer():
+                    full_response = await response_cache.get(cache_key)
+                    if full_response is not None:
+                        await send_long_message(ctx, "**Description:** ", full_response, placeholder)
+                        return full_response
+                    image = await prepare_image(payload)
+                    full_response = await generate_reply(
+                        ctx, "**Description:** ", [image, "Describe this image."], placeholder=placeholder
+                    )
+                    if full_response:
+                        await response_cache.put(cache_key, full_response)
+                    return full_response
+
+                full_response, leader = await single_flight.run(cache_key, answer)
+                if not leader:
+                    await send_long_message(ctx, "**Description:** ", full_response, placeholder)
+            else:
+                await send_long_message(ctx, "**Description:** ", full_response)
     else:
         await safe_send(ctx, "\ud83d\ude14 Please upload an image with this command.")
 
 # Command: Summarize a PDF
-@bot.command(description="Upload a PDF and have it summarized by the AI.")
-async def summarize(ctx):
-    if ctx.message.attachments:
-        attachment = ctx.message.attachments[0]
-        pdf_path = pathlib.Path(f"temp_{attachment.filename}")
-        await attachment.save(pdf_path)
-        await safe_send(ctx, "\ud83d\udcc4 Analyzing PDF...")
-        file_upload = client_gemini.files.upload(path=pdf_path)
-        response = client_gemini.models.generate_content(
-            model=MODEL_ID,
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_uri(
-                            file_uri=file_upload.uri, mime_type=file_upload.mime_type
-                        )
-                    ],
-                ),
-                "Summarize this PDF as bullet points.",
-            ],
-        )
-        full_response = response.candidates[0].content.parts[0].text
-        await send_long_message(ctx, "**Summary:** ", full_response)
-        pdf_path.unlink()
+@bot.hybrid_command(description="Upload a PDF and have it summarized by the AI.")
+@app_commands.describe(pdf="The PDF to summarize")
+async def summarize(ctx, pdf: Optional[discord.Attachment] = None):
+    attachments = command_attachments(ctx, pdf)
+    if len(attachments) > 1:
+        await summarize_batch(ctx, attachments)
+    elif attachments:
+        async with load_attachment(attachments[0]) as payload:
+            placeholder = await safe_send(ctx, "\ud83d\udcc4 Analyzing PDF...")
+            await summarize_pdf(
+                payload, lambda contents: generate_reply(ctx, "**Summary:** ", contents, placeholder=placeholder),
+                placeholder,
+            )
     else:
         await safe_send(ctx, "\ud83d\ude14 Please upload a PDF file with this command.")
 
 # Command: Chat mode
-@bot.command(description="Start a chat session with the AI.")
-async def chat(ctx, *, message=None):
+@bot.hybrid_command(description="Start a chat session with the AI.")
+@app_commands.describe(message="Your next message in the conversation")
+async def chat(ctx, *, message: Optional[str] = None):
     if message is None:
         await safe_send(ctx, "Please provide a message to chat with.")
         return
-    await safe_send(ctx, f"\ud83d\udca1 Thinking...")
-    chat_session = client_gemini.chats.create(
-        model=MODEL_ID, config=types.GenerateContentConfig(temperature=0.5)
-    )
-    response = chat_session.send_message(message)
-    full_response = response.candidates[0].content.parts[0].text
-    await send_long_message(ctx, "**Response:** ", full_response)
+    placeholder = await safe_send(ctx, f"\ud83d\udca1 Thinking...")
+    key = (ctx.guild.id if ctx.guild else None, ctx.channel.id, ctx.author.id)
+    async with chat_sessions.session(key) as chat_session:
+        await generate_reply(ctx, "**Response:** ", message, placeholder=placeholder, chat_session=chat_session)
 
-# Command: Summarize an Audio File
-@bot.command(description="Upload an audio file and have it summarized by the AI.")
-async def summarize_audio(ctx):
-    if ctx.message.attachments:
-        attachment = ctx.message.attachments[0]
-        audio_path = pathlib.Path(f"temp_{attachment.filename}")
-        await attachment.save(audio_path)
-        await safe_send(ctx, "\ud83c\udfa7 Analyzing audio...")
-        file_upload = client_gemini.files.upload(path=audio_path)
-        response = client_gemini.models.generate_content(
-            model=MODEL_ID,
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_uri(
-                            file_uri=file_upload.uri, mime_type=file_upload.mime_type
-                        )
-                    ],
-                ),
-                 "Listen carefully to the following audio file. Provide a brief summary.",
-            ],
+# Command: Ask questions about a PDF
+@bot.hybrid_command(description="Ask about a PDF; later questions in this channel reuse the document.")
+@app_commands.describe(
+    question="What you want to know about the document",
+    pdf="The PDF to ask about; leave out to keep asking about the last one",
+)
+async def ask_doc(ctx, pdf: Optional[discord.Attachment] = None, *, question: str):
+    key = ctx.channel.id
+    attachments = command_attachments(ctx, pdf)
+    placeholder = None
+    if attachments:
+        async with load_attachment(attachments[0]) as payload:
+            placeholder = await safe_send(ctx, "\ud83d\udcc4 Reading PDF...")
+            await with_upload(
+                payload, lambda file_upload, _: document_caches.bind(key, attachments[0].filename, file_upload),
+            )
+    entry = await document_caches.get(key)
+    if entry is None:
+        await safe_send(ctx, "\ud83d\ude14 Please upload a PDF with this command first.")
+        return
+    if placeholder is None:
+        placeholder = await safe_send(ctx, "\ud83d\udca1 Thinking about your question...")
+    prefix = f"**Answer** ({entry['filename']}): "
+    if entry["cache"] is None:
+        await generate_reply(ctx, prefix, [file_content(entry["file"]), question], placeholder, model=DOC_MODEL_ID)
+        return
+    try:
+        await generate_reply(
+            ctx, prefix, question, placeholder, model=DOC_MODEL_ID,
+            config=types.GenerateContentConfig(cached_content=entry["cache"]),
         )
-        full_response = response.candidates[0].content.parts[0].text
-        await send_long_message(ctx, "**Audio Summary:** ", full_response)
-        audio_path.unlink()
+    except errors.ClientError as e:
+        # The cache (or its file) is gone; the document has to be uploaded again
+        if e.code in (403, 404):
+            await document_caches.drop(key)
+        raise
+
+# Command: Summarize an Audio File
+@bot.hybrid_command(description="Upload an audio file and have it summarized by the AI.")
+@app_commands.describe(audio="The audio file to summarize")
+async def summarize_audio(ctx, audio: Optional[discord.Attachment] = None):
+    attachments = command_attachments(ctx, audio)
+    if attachments:
+        await preflight(attachments[0])
+        job_id = await job_queue.submit(ctx, attachments[0])
+        await safe_send(ctx, f"\ud83c\udfa7 Audio queued as job #{job_id}; the summary will be posted here.")
     else:
         await safe_send(ctx, "\ud83d\ude14 Please upload an audio file with this command.")
 
 
 # Command: Describe a Video File
-@bot.command(description="Upload a video file and have it described by the AI.")
-async def describe_video(ctx):
-    if ctx.message.attachments:
-        attachment = ctx.message.attachments[0]
-        video_path = pathlib.Path(f"temp_{attachment.filename}")
-        await attachment.save(video_path)
-        await safe_send(ctx, "\ud83c\udfa5 Analyzing video...")
-        file_upload = client_gemini.files.upload(path=video_path)
+@bot.hybrid_command(description="Upload a video file and have it described by the AI.")
+@app_commands.describe(video="The video to describe")
+async def describe_video(ctx, video: Optional[discord.Attachment] = None):
+    attachments = command_attachments(ctx, video)
+    if attachments and HAVE_CV2 and attachments[0].size <= VIDEO_FAST_MAX_BYTES:
+        attachment = attachments[0]
+        placeholder = await safe_send(ctx, "\ud83c\udfa5 Analyzing video...")
+        try:
+            async with load_attachment(attachment) as payload:
+                contents = await video_keyframe_contents(payload)
+        except AttachmentRejected as error:
+            await placeholder.edit(content=error_message(error))
+            return
+        if contents is not None:
+            full_response = await generate_reply(ctx, "**Video Description:** ", contents, placeholder=placeholder)
+            log.info("Video Description: %s", Truncated(full_response))
+            return
+        # Too long for the fast path: the job reuses the download unless it
+        # went to a temp file, which is gone by now
+        if payload.data is not None:
+            attachment = StoredAttachment(
+                attachment.filename, attachment.content_type, attachment.size, attachment.url, payload
+            )
+        job_id = await job_queue.submit(ctx, attachment)
+        await placeholder.edit(content=f"\ud83c\udfa5 Video queued as job #{job_id}; the description will be posted here.")
+    elif attachments:
+        await preflight(attachments[0])
+        job_id = await job_queue.submit(ctx, attachments[0])
+        await safe_send(ctx, f"\ud83c\udfa5 Video queued as job #{job_id}; the description will be posted here.")
+    else:
+        await safe_send(ctx, "\ud83d\ude14 Please upload a video file with this command.")
 
-        # Wait for video processing to complete
-        await safe_send(ctx, "Waiting for video to be processed...")
-        while True:
-            time.sleep(10) # Check every 10 seconds
-            file_upload = client_gemini.files.get(name=file_upload.name)
-            if file_upload.state == "PROCESSING":
-                await safe_send(ctx, "Video processing still in progress, please wait...")
-                continue
-            elif file_upload.state == "FAILED":
-                await safe_send(ctx, "Video processing failed.")
-                video_path.unlink()
-                return
-            elif file_upload.state == "ACTIVE":
-                break
-        await safe_send(ctx, "Video processing complete. Generating Description")
-        response = client_gemini.models.generate_content(
-            model=MODEL_ID,
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_uri(
-                            file_uri=file_upload.uri,
-                            mime_type=file_upload.mime_type),
-                    ]),
-                "Describe this video.",
-            ]
+
+# Command: List the background jobs of this channel
+@bot.hybrid_command(description="List the latest audio and video jobs in this channel.")
+async def jobs(ctx):
+    rows = await job_queue.recent(ctx.channel.id)
+    if not rows:
+        await safe_send(ctx, "No jobs in this channel yet.")
+        return
+    now = time.time()
+    lines = []
+    for job_id, command, filename, state, error, created in rows:
+        line = f"#{job_id} /{command} {filename}: {state} ({int(now - created) // 60} min ago)"
+        if state == "failed" and error:
+            line += f" - {error[:100]}"
+        lines.append(line)
+    await send_long_message(ctx, "", "\n".join(lines))
+
+
+# Tell the user when a command failed because Gemini could not be reached
+@bot.event
+async def on_command_error(ctx, error):
+    # Slash command failures are wrapped twice (HybridCommandError around
+    # app_commands.CommandInvokeError)
+    original = error
+    while getattr(original, "original", None) is not None:
+        original = original.original
+    message = error_message(original)
+    if message is not None:
+        await safe_send(ctx, message)
+    await commands.Bot.on_command_error(bot, ctx, error)
+
+
+# Command: Show timing percentiles, cache and queue statistics
+@bot.hybrid_command(description="Show bot performance statistics (administrators only).")
+@commands.has_permissions(administrator=True)
+@app_commands.default_permissions(administrator=True)
+async def stats(ctx):
+    width = max([len(stage) + 2 for _, stage in timings] + [12])
+    lines = [f"{'command':<16}{'stage':<{width}}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}"]
+    for (command, stage), histogram in sorted(timings.items()):
+        lines.append(
+            f"{command:<16}{stage:<{width}}{histogram.count:>7}"
+            + "".join(f"{histogram.percentile(q):>9.3f}" for q in (0.5, 0.95, 0.99))
         )
-        full_response = response.candidates[0].content.parts[0].text
+    lines.append("")
+    lines.append(f"response cache: {response_cache.hits} hits, {response_cache.misses} misses")
+    lines.append(f"requests sharing an in-flight call: {single_flight.shared}")
+    lines.append(f"cached documents: {len(document_caches.documents)}")
+    lines.append(f"queue depth by lane: {gemini_scheduler.depth()}")
+    waits = gemini_scheduler.wait_percentiles(0.95)
+    lines.append(f"queue wait p95 by lane: {({lane: round(wait, 3) for lane, wait in waits.items()})}")
+    lines.append(f"circuit breaker: {gemini_breaker.state}")
+    await send_long_message(ctx, "", "```\n" + "\n".join(lines) + "\n```")
 
-        # Print to terminal
-        print(f"Video Description:\n{full_response}")
+# Metrics in the Prometheus text format, served on METRICS_HOST:METRICS_PORT
+# when METRICS_PORT is set.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT")
 
-        await send_long_message(ctx, "**Video Description:** ", full_response)
-        video_path.unlink()
-    else:
-        await safe_send(ctx, "\ud83d\ude14 Please upload a video file with this command.")
+def metrics_text():
+    lines = ["# TYPE discord_bot_stage_seconds summary"]
+    for (command, stage), histogram in sorted(timings.items()):
+        labels = f'command="{command}",stage="{stage}"'
+        for q in (0.5, 0.95, 0.99):
+            lines.append(f'discord_bot_stage_seconds{{{labels},quantile="{q}"}} {histogram.percentile(q):.6f}')
+        lines.append(f"discord_bot_stage_seconds_sum{{{labels}}} {histogram.sum:.6f}")
+        lines.append(f"discord_bot_stage_seconds_count{{{labels}}} {histogram.count}")
+    lines.append("# TYPE discord_bot_response_cache_hits_total counter")
+    lines.append(f"discord_bot_response_cache_hits_total {response_cache.hits}")
+    lines.append("# TYPE discord_bot_response_cache_misses_total counter")
+    lines.append(f"discord_bot_response_cache_misses_total {response_cache.misses}")
+    lines.append("# TYPE discord_bot_single_flight_shared_total counter")
+    lines.append(f"discord_bot_single_flight_shared_total {single_flight.shared}")
+    lines.append("# TYPE discord_bot_queue_depth gauge")
+    for lane, depth in sorted(gemini_scheduler.depth().items()):
+        lines.append(f'discord_bot_queue_depth{{lane="{lane}"}} {depth}')
+    lines.append("# TYPE discord_bot_queue_wait_seconds summary")
+    for q in (0.5, 0.95, 0.99):
+        for lane, wait in gemini_scheduler.wait_percentiles(q).items():
+            lines.append(f'discord_bot_queue_wait_seconds{{lane="{lane}",quantile="{q}"}} {wait:.6f}')
+    lines.append("# TYPE discord_bot_circuit_open gauge")
+    lines.append(f"discord_bot_circuit_open {int(gemini_breaker.state == 'open')}")
+    return "\n".join(lines) + "\n"
+
+async def serve_metrics(reader, writer):
+    try:
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        body = metrics_text().encode("utf-8")
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii")
+            + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+# Close the attachment download session together with the bot
+close_bot = bot.close
+
+async def close():
+    await close_http_session()
+    await close_bot()
+
+bot.close = close
+
+@bot.event
+async def setup_hook():
+    job_queue.start()
+    document_caches.start()
+    if METRICS_PORT:
+        await asyncio.start_server(serve_metrics, METRICS_HOST, int(METRICS_PORT))
 
 
 # Overwrite the default help command
-@bot.command(name="help", description="Show this help message.")
+@bot.hybrid_command(name="help", description="Show this help message.")
 async def help_command(ctx):
     embed = discord.Embed(title="Bot Commands", color=discord.Color.blue())
     for command in bot.commands:
@@ -219,7 +2467,95 @@ async def help_command(ctx):
 # Run the bot
 @bot.event
 async def on_ready():
-    print(f'Logged in as {bot.user}')
-    await bot.tree.sync()
+    ready = time.perf_counter() - STARTED
+    observe("ready", ready, command="startup")
+    log.info("Logged in as %s (ready %.2fs after start)", bot.user, ready)
+    asyncio.get_running_loop().run_in_executor(None, warm_up)
+    # With several shard processes, only the one running shard 0 syncs
+    if getattr(bot, "shard_ids", None) is None or 0 in bot.shard_ids:
+        await sync_tree()
+
+# Syncing the command tree is a rate-limited API call, so it only happens when
+# the registered commands change. Their hash is kept in TREE_HASH_PATH.
+TREE_HASH_PATH = os.getenv("TREE_HASH_PATH", ".command_tree_hash")
+
+def tree_hash():
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    payload.sort(key=lambda command: (command.get("type", 1), command["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+async def sync_tree():
+    digest = tree_hash()
+    try:
+        if pathlib.Path(TREE_HASH_PATH).read_text().strip() == digest:
+            log.info("Command tree unchanged, skipping sync")
+            return
+    except OSError:
+        pass
+    with span("sync", command="startup"):
+        await bot.tree.sync()
+    pathlib.Path(TREE_HASH_PATH).write_text(digest + "\n")
+    log.info("Synced command tree")
+
+# Supervisor for BOT_PROCESSES worker processes, each running every
+# BOT_PROCESSES-th shard. A worker that exits is restarted after a backoff that
+# doubles with each quick failure (up to a minute).
+def supervise():
+    shard_count = int(SHARD_COUNT or BOT_PROCESSES)
+    workers = [{"process": None, "started": 0.0, "failures": 0, "restart_at": 0.0}
+               for _ in range(BOT_PROCESSES)]
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    def spawn(index):
+        env = dict(
+            os.environ,
+            BOT_PROCESSES="1",
+            SHARD_COUNT=str(shard_count),
+            SHARD_IDS=",".join(str(shard) for shard in range(index, shard_count, BOT_PROCESSES)),
+        )
+        env.setdefault("SHARED_STATE_PATH", "shared_state.sqlite3")
+        env.setdefault("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+        env.setdefault("LOG_FILE", f"bot.worker{index}.log")
+        log.info("Starting worker %d with shards %s", index, env["SHARD_IDS"])
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    while not stopping:
+        now = time.monotonic()
+        for index, worker in enumerate(workers):
+            process = worker["process"]
+            if process is not None and process.poll() is None:
+                if now - worker["started"] > 60:
+                    worker["failures"] = 0
+                continue
+            if process is not None:
+                worker["failures"] += 1
+                worker["restart_at"] = now + min(60, 2 ** (worker["failures"] - 1))
+                worker["process"] = None
+                log.warning("Worker %d exited with code %s", index, process.returncode)
+            if now >= worker["restart_at"]:
+                worker["process"] = spawn(index)
+                worker["started"] = now
+        time.sleep(1)
 
-bot.run(TOKEN)
\ No newline at end of file
+    for worker in workers:
+        if worker["process"] is not None:
+            worker["process"].terminate()
+    for worker in workers:
+        if worker["process"] is not None:
+            try:
+                worker["process"].wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                worker["process"].kill()
+
+if __name__ == "__main__":
+    if BOT_PROCESSES > 1:
+        supervise()
+    else:
+        bot.run(TOKEN)
\ No newline at end of file
@@ -0,0 +1,92 @@
+# bot.py reads its configuration at import time; keep its state files out of
+# the working directory and its log quiet while the tests run.
+import os
+import sys
+import tempfile
+
+STATE_DIR = tempfile.mkdtemp(prefix="bot_tests_")
+os.environ.setdefault("DISCORD_BOT_TOKEN", "test")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("UPLOAD_CACHE_PATH", os.path.join(STATE_DIR, "upload_cache.sqlite3"))
+os.environ.setdefault("JOBS_PATH", os.path.join(STATE_DIR, "jobs.sqlite3"))
+os.environ.setdefault("TREE_HASH_PATH", os.path.join(STATE_DIR, "command_tree_hash"))
+os.environ.setdefault("LOG_FILE", "")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio  # noqa: E402
+import types  # noqa: E402
+
+import pytest  # noqa: E402
+
+import bot  # noqa: E402
+
+
+# A clock the tests move by hand; sleeping advances it instead of waiting
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+        await asyncio.sleep(0)
+
+
+class FakeMessage:
+    def __init__(self, channel, content, attachments=()):
+        self.channel = channel
+        self.content = content
+        self.attachments = list(attachments)
+
+    async def edit(self, content=None, attachments=None, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        self.content = content
+        if attachments is not None:
+            self.attachments = attachments
+        return self
+
+    async def delete(self):
+        self.channel.sent.remove(self)
+
+
+# A prefix command context that keeps the messages it sent; `latency` delays
+# every send and edit like a round trip to Discord
+class FakeContext:
+    def __init__(self, user=1, command="ask", latency=0):
+        self.command = types.SimpleNamespace(name=command)
+        self.guild = types.SimpleNamespace(id=1)
+        self.author = types.SimpleNamespace(id=user)
+        self.channel = types.SimpleNamespace(id=1)
+        self.message = types.SimpleNamespace(attachments=[])
+        self.interaction = None
+        self.latency = latency
+        self.sent = []
+
+    async def send(self, content=None, file=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        message = FakeMessage(self, content, [file] if file else ())
+        self.sent.append(message)
+        return message
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def fake_context():
+    return FakeContext
+
+
+# Calls Gemini directly, without the scheduler, retries and breaker
+@pytest.fixture
+def inline_gemini(monkeypatch):
+    async def run_gemini(func, *args, quota_model=None, **kwargs):
+        return func(*args, **kwargs)
+
+    monkeypatch.setattr(bot, "run_gemini", run_gemini)
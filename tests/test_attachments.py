@@ -0,0 +1,62 @@
+import types
+
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize("head, mime_type", [
+    (b"\x89PNG\r\n\x1a\n" + bytes(24), "image/png"),
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF", "image/jpeg"),
+    (b"GIF89a" + bytes(10), "image/gif"),
+    (b"BM\x36\x00\x0c\x00\x00\x00\x00\x00\x36\x00\x00\x00", "image/bmp"),
+    (b"II*\x00\x08\x00\x00\x00", "image/tiff"),
+    (b"MM\x00*\x00\x00\x00\x08", "image/tiff"),
+    (b"RIFF\x24\x00\x00\x00WEBPVP8 ", "image/webp"),
+    (b"RIFF\x24\x00\x00\x00WAVEfmt ", "audio/wav"),
+    (b"%PDF-1.7\n", "application/pdf"),
+    (b"\x00\x00\x00\x20ftypM4A \x00\x00\x00\x00", "audio/mp4"),
+    (b"\x00\x00\x00\x20ftypisom\x00\x00\x02\x00", "video/mp4"),
+    (b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01", "video/webm"),
+    (b"OggS\x00\x02", "audio/ogg"),
+    (b"ID3\x04\x00", "audio/mpeg"),
+    (b"BMP is not a bitmap", None),
+    (b"plain text", None),
+])
+def test_sniff_mime_type(head, mime_type):
+    assert bot.sniff_mime_type(head) == mime_type
+
+
+@pytest.mark.parametrize("head, filename, content_type, command, mime_type", [
+    # Audio-only MP4 and WebM/Matroska files with a generic header
+    (b"\x00\x00\x00\x20ftypisom", "voice.m4a", "audio/x-m4a", "summarize_audio", "audio/mp4"),
+    (b"\x00\x00\x00\x20ftypmp42", "voice.m4a", None, "summarize_audio", "audio/mp4"),
+    (b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81", "voice.webm", "audio/webm", "summarize_audio", "audio/webm"),
+    (b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81", "voice.mka", "application/octet-stream", "summarize_audio", "audio/webm"),
+    # The same containers declared as video stay video
+    (b"\x00\x00\x00\x20ftypisom", "clip.mp4", "video/mp4", "describe_video", "video/mp4"),
+    (b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81", "clip.webm", None, "describe_video", "video/webm"),
+    (b"BM\x36\x00\x0c\x00\x00\x00\x00\x00", "scan.bmp", "image/bmp", "describe", "image/bmp"),
+])
+def test_preflight_accepts(monkeypatch, head, filename, content_type, command, mime_type):
+    async def read_head(url, size=64):
+        return head
+
+    monkeypatch.setattr(bot, "read_head", read_head)
+    attachment = types.SimpleNamespace(filename=filename, content_type=content_type, size=1000, url="")
+    assert bot.asyncio.run(bot.preflight(attachment, command))[0] == mime_type
+
+
+@pytest.mark.parametrize("head, filename, content_type, command", [
+    (b"\x00\x00\x00\x20ftypisom", "voice.m4a", "audio/x-m4a", "describe_video"),
+    (b"\x00\x00\x00\x20ftypisom", "clip.mp4", "video/mp4", "summarize_audio"),
+    (b"%PDF-1.7\n", "song.mp3", "audio/mpeg", "summarize_audio"),
+])
+def test_preflight_rejects(monkeypatch, head, filename, content_type, command):
+    async def read_head(url, size=64):
+        return head
+
+    monkeypatch.setattr(bot, "read_head", read_head)
+    attachment = types.SimpleNamespace(filename=filename, content_type=content_type, size=1000, url="")
+    with pytest.raises(bot.AttachmentRejected):
+        bot.asyncio.run(bot.preflight(attachment, command))
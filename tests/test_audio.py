@@ -0,0 +1,89 @@
+import io
+import wave
+
+import pytest
+
+import bot
+
+np = pytest.importorskip("numpy")
+
+
+def make_wav(seconds, rate=44100, channels=2, width=2, frequency=1000.0):
+    t = np.arange(int(seconds * rate)) / rate
+    signal = 0.5 * np.sin(2 * np.pi * frequency * t)
+    if width == 1:
+        samples = np.round(signal * 127 + 128).astype(np.uint8)
+    else:
+        samples = np.round(signal * 32767).astype("<i2")
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(width)
+        wav.setframerate(rate)
+        wav.writeframes(np.repeat(samples, channels).tobytes())
+    return out.getvalue()
+
+
+def transcode(data, **kwargs):
+    return bot.transcode_wav(io.BytesIO(data), **kwargs)
+
+
+def dominant_frequency(pcm, rate):
+    samples = np.frombuffer(pcm, "<i2").astype(np.float64)
+    spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+    return np.argmax(spectrum) * rate / len(samples)
+
+
+def test_transcode_to_16_khz_mono():
+    pcm, rate = transcode(make_wav(3, frequency=1000), rate=16000)
+    assert rate == 16000
+    assert abs(len(pcm) // 2 - 3 * 16000) <= 1
+    assert dominant_frequency(pcm, rate) == pytest.approx(1000, abs=2)
+
+
+def test_transcode_is_independent_of_block_size():
+    data = make_wav(3, rate=22050, frequency=440)
+    whole, _ = transcode(data, rate=16000, block_seconds=30)
+    blocks, _ = transcode(data, rate=16000, block_seconds=1)
+    assert len(whole) == len(blocks)
+    assert np.abs(np.frombuffer(whole, "<i2").astype(int) - np.frombuffer(blocks, "<i2")).max() <= 1
+
+
+def test_low_rate_input_is_not_upsampled():
+    pcm, rate = transcode(make_wav(2, rate=8000, channels=2, frequency=300), rate=16000)
+    assert rate == 8000
+    assert len(pcm) // 2 == 2 * 8000
+    assert dominant_frequency(pcm, rate) == pytest.approx(300, abs=2)
+
+
+@pytest.mark.parametrize("rate, channels, width", [(8000, 1, 1), (16000, 1, 2), (8000, 1, 2)])
+def test_files_that_would_not_shrink_are_kept(rate, channels, width):
+    assert transcode(make_wav(1, rate=rate, channels=channels, width=width), rate=16000) is None
+
+
+def test_segments_overlap(monkeypatch):
+    monkeypatch.setattr(bot, "AUDIO_SEGMENT_SECONDS", 10)
+    monkeypatch.setattr(bot, "AUDIO_SEGMENT_OVERLAP", 2)
+    payload = bot.AttachmentPayload("talk.wav", "audio/wav", data=make_wav(25, rate=16000))
+    segments = bot.audio_segments(payload, rate=8000)
+    assert [(start, end) for start, end, _ in segments] == [(0, 10), (8, 18), (16, 25)]
+
+    parts = []
+    for start, end, data in segments:
+        with wave.open(io.BytesIO(data)) as wav:
+            assert (wav.getnchannels(), wav.getsampwidth(), wav.getframerate()) == (1, 2, 8000)
+            parts.append(np.frombuffer(wav.readframes(wav.getnframes()), "<i2"))
+    assert [len(part) for part in parts] == [10 * 8000, 10 * 8000, 9 * 8000]
+    # Each segment starts with the last AUDIO_SEGMENT_OVERLAP seconds of the one before
+    for previous, part in zip(parts, parts[1:]):
+        assert np.array_equal(previous[-2 * 8000:], part[:2 * 8000])
+
+
+def test_short_recording_is_one_segment():
+    payload = bot.AttachmentPayload("memo.wav", "audio/wav", data=make_wav(5))
+    [(start, end, data)] = bot.audio_segments(payload)
+    assert (start, end) == (0, 5)
+
+
+def test_compressed_wav_is_not_transcoded():
+    assert transcode(b"RIFF\x00\x00\x00\x00WAVEfmt " + bytes(40)) is None
@@ -0,0 +1,51 @@
+import asyncio
+import types
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    requests = []
+
+    @bot.contextlib.asynccontextmanager
+    async def load_attachment(attachment, command=None):
+        yield bot.AttachmentPayload(attachment.filename, "image/png", data=attachment.filename.encode())
+
+    async def prepare_image(payload):
+        return payload.filename
+
+    async def generate_text(contents):
+        images, prompt = contents[:-1], contents[-1]
+        requests.append(images)
+        if len(images) == 1:
+            return f"one {images[0]}"
+        return "\n".join(f"### Image {k}\npacked {image}" for k, image in enumerate(images, 1))
+
+    monkeypatch.setattr(bot, "load_attachment", load_attachment)
+    monkeypatch.setattr(bot, "prepare_image", prepare_image)
+    monkeypatch.setattr(bot, "generate_text", generate_text)
+    monkeypatch.setattr(bot, "response_cache", bot.ResponseCache(100, 60))
+    monkeypatch.setattr(bot, "IMAGE_PACK_LIMIT", 4)
+    return requests
+
+
+def describe(ctx, count):
+    attachments = [types.SimpleNamespace(filename=f"img{i}.png") for i in range(count)]
+    asyncio.run(bot.describe_batch(ctx, attachments))
+    return ctx.sent[0].content
+
+
+@pytest.mark.parametrize("count, sizes", [(2, [2]), (4, [4]), (5, [2, 3]), (9, [3, 3, 3]), (10, [3, 3, 4])])
+def test_images_are_packed_in_groups(requests, fake_context, count, sizes):
+    content = describe(fake_context(), count)
+    assert sorted(len(images) for images in requests) == sizes
+    assert sorted(image for images in requests for image in images) == sorted(f"img{i}.png" for i in range(count))
+    for i in range(count):
+        assert f"**Description of img{i}.png:** packed img{i}.png" in content
+
+
+def test_single_image_is_not_packed(requests, fake_context):
+    assert describe(fake_context(), 1) == "**Description of img0.png:** one img0.png"
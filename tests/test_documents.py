@@ -0,0 +1,73 @@
+import asyncio
+import types
+
+import pytest
+
+import bot
+
+
+def client_error(message):
+    return bot.errors.ClientError(400, {"error": {"code": 400, "message": message, "status": "INVALID_ARGUMENT"}})
+
+
+@pytest.fixture
+def caches(monkeypatch, inline_gemini):
+    caches = types.SimpleNamespace(error=None, created=[], deleted=[])
+
+    def create(*, model, config):
+        if caches.error is not None:
+            raise caches.error
+        caches.created.append(config.display_name)
+        return types.SimpleNamespace(name=f"cachedContents/{len(caches.created)}")
+
+    def delete(*, name):
+        caches.deleted.append(name)
+
+    monkeypatch.setattr(bot, "client_gemini", types.SimpleNamespace(
+        caches=types.SimpleNamespace(create=create, delete=delete),
+    ))
+    return caches
+
+
+def file_upload():
+    return bot.types.File(name="files/1", uri="https://example.com/files/1", mime_type="application/pdf")
+
+
+def test_document_is_cached(caches):
+    documents = bot.DocumentCacheManager()
+    asyncio.run(documents.bind(1, "report.pdf", file_upload()))
+    assert documents.documents[1]["cache"] == "cachedContents/1"
+
+
+def test_small_document_is_sent_with_each_question(caches):
+    caches.error = client_error("Cached content is too small. total_token_count=900, min_total_token_count=4096")
+    documents = bot.DocumentCacheManager()
+    asyncio.run(documents.bind(1, "memo.pdf", file_upload()))
+    assert documents.documents[1]["cache"] is None
+    assert documents.documents[1]["file"].name == "files/1"
+
+
+def test_other_bad_requests_are_raised(caches):
+    caches.error = client_error("Model gemini-x does not support cached content.")
+    documents = bot.DocumentCacheManager()
+    with pytest.raises(bot.errors.ClientError):
+        asyncio.run(documents.bind(1, "report.pdf", file_upload()))
+    assert 1 not in documents.documents
+
+
+@pytest.mark.parametrize("code, dropped", [(404, True), (403, True), (400, False), (429, False)])
+def test_ask_doc_forgets_the_document_only_when_its_cache_is_gone(caches, fake_context, monkeypatch, code, dropped):
+    documents = bot.DocumentCacheManager()
+    asyncio.run(documents.bind(1, "report.pdf", file_upload()))
+    monkeypatch.setattr(bot, "document_caches", documents)
+
+    async def generate_reply(*args, **kwargs):
+        raise bot.errors.ClientError(code, {"error": {"code": code, "message": "injected", "status": "X"}})
+
+    monkeypatch.setattr(bot, "generate_reply", generate_reply)
+    ctx = fake_context()
+    with pytest.raises(bot.errors.ClientError) as raised:
+        asyncio.run(bot.bot.get_command("ask_doc").callback(ctx, question="What is it about?"))
+    assert raised.value.code == code
+    assert (1 not in documents.documents) == dropped
+    assert caches.deleted == (["cachedContents/1"] if dropped else [])
@@ -0,0 +1,87 @@
+import asyncio
+import time
+import types
+
+import discord
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+    return bot.JobQueue(str(tmp_path / "jobs.sqlite3"))
+
+
+def stored_job(job_queue, channel=42):
+    now = time.time()
+    cursor = job_queue.db.execute(
+        "INSERT INTO jobs (command, guild, channel, user, filename, content_type, size, url, "
+        "state, created, updated) VALUES ('describe_video', 1, ?, 7, 'clip.mp4', 'video/mp4', 10, "
+        "'https://cdn.example/clip.mp4', 'queued', ?, ?)",
+        (channel, now, now),
+    )
+    job_queue.db.commit()
+    return cursor.lastrowid
+
+
+def state(job_queue, job_id):
+    return job_queue.db.execute("SELECT state, error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def test_job_for_a_missing_channel_fails(job_queue, monkeypatch):
+    async def fetch_channel(channel_id):
+        raise discord.NotFound(types.SimpleNamespace(status=404, reason="Not Found"), "Unknown Channel")
+
+    monkeypatch.setattr(bot.bot, "get_channel", lambda channel_id: None)
+    monkeypatch.setattr(bot.bot, "fetch_channel", fetch_channel)
+    job_id = stored_job(job_queue)
+    asyncio.run(job_queue.run(job_id))
+    job_state, error = state(job_queue, job_id)
+    assert job_state == "failed"
+    assert "Unknown Channel" in error
+
+
+def test_recovered_job_runs_in_its_channel(job_queue, monkeypatch):
+    sent = []
+
+    class Channel:
+        async def send(self, content=None, **kwargs):
+            sent.append(content)
+
+    async def handler(attachment):
+        assert attachment.url == "https://cdn.example/clip.mp4"
+        return "A cat."
+
+    monkeypatch.setattr(bot.bot, "get_channel", lambda channel_id: Channel())
+    monkeypatch.setitem(bot.JOB_COMMANDS, "describe_video", ("Video Description", handler))
+    job_id = stored_job(job_queue)
+    asyncio.run(job_queue.run(job_id))
+    assert state(job_queue, job_id) == ("done", None)
+    assert sent == [f"<@7> **Video Description** (job #{job_id}): A cat."]
+
+
+def test_database_work_stays_off_the_event_loop(job_queue, monkeypatch):
+    threads = set()
+    write = job_queue.write
+
+    def record_write(*args, **kwargs):
+        threads.add(bot.threading.current_thread().name)
+        return write(*args, **kwargs)
+
+    monkeypatch.setattr(job_queue, "write", record_write)
+    ctx = types.SimpleNamespace(
+        command=types.SimpleNamespace(name="describe_video"), guild=types.SimpleNamespace(id=1),
+        channel=types.SimpleNamespace(id=42), author=types.SimpleNamespace(id=7),
+    )
+    attachment = types.SimpleNamespace(filename="clip.mp4", content_type="video/mp4", size=10, url="u")
+
+    async def main():
+        job_queue.queue = asyncio.Queue()
+        job_id = await job_queue.submit(ctx, attachment)
+        await job_queue.update(job_id, state="running")
+        return job_id, await job_queue.recent(42)
+
+    job_id, rows = asyncio.run(main())
+    assert [(row[0], row[3]) for row in rows] == [(job_id, "running")]
+    assert threads and all(name.startswith("shared-state") for name in threads)
@@ -0,0 +1,81 @@
+import asyncio
+import gc
+import time
+import types
+
+import pytest
+
+import bot
+
+LATENCY = 0.3
+
+
+# A Gemini client whose calls block their thread for LATENCY seconds, like the
+# real synchronous SDK
+class FakeModels:
+    def generate_content(self, *, model, contents, config=None):
+        time.sleep(LATENCY)
+        return bot.types.GenerateContentResponse(
+            candidates=[{"content": {"role": "model", "parts": [{"text": f"About {contents}."}]}}],
+        )
+
+    def generate_content_stream(self, *, model, contents, config=None):
+        for _ in range(3):
+            time.sleep(LATENCY / 3)
+            yield bot.types.GenerateContentResponse(
+                candidates=[{"content": {"role": "model", "parts": [{"text": "Some words. "}]}}],
+            )
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    monkeypatch.setattr(bot, "client_gemini", types.SimpleNamespace(models=FakeModels()))
+    monkeypatch.setattr(bot, "gemini_scheduler", bot.GeminiScheduler(model_rpm=10**6, key_rpm=10**6, burst=10**6))
+    monkeypatch.setattr(bot, "gemini_executor", bot.ThreadPoolExecutor(max_workers=50))
+    monkeypatch.setattr(bot, "response_cache", bot.ResponseCache(1000, 60))
+
+
+# Runs `users` concurrent /ask commands while sampling how late a 10 ms timer
+# fires; a blocked event loop shows up as lag. Returns the elapsed time and the
+# worst lag.
+def load(fake_context, users):
+    ask = bot.bot.get_command("ask")
+
+    async def one(user):
+        ctx = fake_context(user, latency=0.001)
+        await bot.set_request_context(ctx)
+        await ask.callback(ctx, question=f"Question {user} {time.time()}?")
+
+    async def main():
+        lag = []
+        done = asyncio.Event()
+
+        async def monitor():
+            loop = asyncio.get_running_loop()
+            while not done.is_set():
+                start = loop.time()
+                await asyncio.sleep(0.01)
+                lag.append(loop.time() - start - 0.01)
+
+        # A full garbage collection pause would show up as lag unrelated to the bot
+        gc.collect()
+        sampler = asyncio.create_task(monitor())
+        start = time.perf_counter()
+        await asyncio.gather(*(one(user) for user in range(users)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await sampler
+        return elapsed, max(lag)
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_event_loop_lag_stays_flat_under_50_concurrent_asks(fake_gemini, fake_context, monkeypatch, stream):
+    monkeypatch.setattr(bot, "STREAM_RESPONSES", stream)
+    single, _ = load(fake_context, 1)
+    elapsed, lag = load(fake_context, 50)
+    # Calls block worker threads, not the event loop: 50 users take about as
+    # long as one, and timers keep firing on time
+    assert lag < 0.05
+    assert elapsed < single + 2 * LATENCY
@@ -0,0 +1,179 @@
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+# A blocking Gemini call that fails with the given errors, in order, before
+# answering. A number instead of an error makes that attempt hang for as many
+# seconds first, and `stall` hangs a stream between its chunks.
+class FlakyCall:
+    def __init__(self, *failures, stall=0):
+        self.failures = list(failures)
+        self.stall = stall
+        self.calls = 0
+
+    def fail(self):
+        failure = self.failures.pop(0)
+        if isinstance(failure, Exception):
+            raise failure
+        time.sleep(failure)
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        if self.failures:
+            self.fail()
+        return "ok"
+
+    def stream(self, **kwargs):
+        self.calls += 1
+        if self.failures:
+            self.fail()
+        for i, text in enumerate(("o", "k")):
+            if i:
+                time.sleep(self.stall)
+            yield bot.types.GenerateContentResponse(
+                candidates=[{"content": {"role": "model", "parts": [{"text": text}]}}],
+            )
+
+
+def api_error(code):
+    return bot.errors.APIError(code, {"error": {"code": code, "message": "injected", "status": "INJECTED"}})
+
+
+@pytest.fixture
+def clock(clock, monkeypatch):
+    monkeypatch.setattr(bot, "gemini_breaker", bot.CircuitBreaker(threshold=3, cooldown=30, clock=clock))
+    monkeypatch.setattr(bot, "gemini_scheduler", bot.GeminiScheduler(model_rpm=10**6, key_rpm=10**6, burst=10**6))
+    monkeypatch.setattr(bot, "GEMINI_BACKOFF", 0)
+    monkeypatch.setattr(bot, "GEMINI_RETRIES", 3)
+    return clock
+
+
+async def collect(stream):
+    return "".join([chunk async for chunk in stream])
+
+
+def test_retryable_errors():
+    assert bot.is_retryable(api_error(429))
+    assert bot.is_retryable(api_error(503))
+    assert bot.is_retryable(asyncio.TimeoutError())
+    assert bot.is_retryable(ConnectionError())
+    assert not bot.is_retryable(api_error(400))
+    assert not bot.is_retryable(ValueError())
+
+
+def test_transient_errors_are_retried(clock):
+    call = FlakyCall(api_error(503), api_error(429))
+    assert asyncio.run(bot.run_gemini(call, model="model")) == "ok"
+    assert call.calls == 3
+    assert bot.gemini_breaker.failures == 0
+
+
+def test_retries_give_up(clock):
+    call = FlakyCall(*(api_error(500) for _ in range(10)))
+    bot.gemini_breaker.threshold = 10
+    with pytest.raises(bot.errors.APIError):
+        asyncio.run(bot.run_gemini(call, model="model"))
+    assert call.calls == bot.GEMINI_RETRIES + 1
+
+
+def test_client_errors_are_not_retried_but_prove_gemini_is_up(clock):
+    bot.gemini_breaker.failures = 2
+    call = FlakyCall(api_error(400))
+    with pytest.raises(bot.errors.APIError):
+        asyncio.run(bot.run_gemini(call, model="model"))
+    assert call.calls == 1
+    assert bot.gemini_breaker.failures == 0
+
+
+def test_local_errors_leave_the_breaker_alone(clock):
+    bot.gemini_breaker.failures = 2
+    call = FlakyCall(ValueError("bug"))
+    with pytest.raises(ValueError):
+        asyncio.run(bot.run_gemini(call, model="model"))
+    assert call.calls == 1
+    assert bot.gemini_breaker.failures == 2
+
+
+def test_breaker_opens_and_recovers(clock):
+    # The third failure opens the breaker, which also stops the retries
+    call = FlakyCall(*(api_error(503) for _ in range(3)))
+    with pytest.raises(bot.GeminiUnavailable):
+        asyncio.run(bot.run_gemini(call, model="model"))
+    assert call.calls == 3
+    assert bot.gemini_breaker.state == "open"
+
+    # While open, calls fail without reaching Gemini
+    with pytest.raises(bot.GeminiUnavailable):
+        asyncio.run(bot.run_gemini(call, model="model"))
+    assert call.calls == 3
+
+    # After the cooldown a single trial call is let through and closes it
+    clock.now += 30
+    assert bot.gemini_breaker.state == "half-open"
+    assert asyncio.run(bot.run_gemini(call, model="model")) == "ok"
+    assert bot.gemini_breaker.state == "closed"
+
+
+def test_failed_trial_reopens_the_breaker(clock):
+    bot.gemini_breaker.opened_at = 0.0
+    clock.now += 30
+    call = FlakyCall(api_error(503))
+    bot.GEMINI_RETRIES = 0
+    with pytest.raises(bot.errors.APIError):
+        asyncio.run(bot.run_gemini(call, model="model"))
+    assert bot.gemini_breaker.state == "open"
+
+
+def test_stream_is_retried_before_the_first_chunk(clock):
+    call = FlakyCall(api_error(503), ConnectionError())
+    assert asyncio.run(collect(bot.stream_gemini(call.stream, model="model"))) == "ok"
+    assert call.calls == 3
+    assert bot.gemini_breaker.failures == 0
+
+
+@pytest.fixture
+def slow(clock, monkeypatch):
+    monkeypatch.setattr(bot, "GEMINI_TIMEOUT", 0.05)
+    return 0.2
+
+
+def test_slow_calls_time_out_and_are_retried(slow):
+    call = FlakyCall(slow, slow)
+    assert asyncio.run(bot.run_gemini(call, model="model")) == "ok"
+    assert call.calls == 3
+    assert bot.gemini_breaker.failures == 0
+
+
+def test_slow_calls_give_up(slow):
+    call = FlakyCall(*(slow for _ in range(10)))
+    bot.gemini_breaker.threshold = 10
+    bot.GEMINI_RETRIES = 1
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(bot.run_gemini(call, model="model"))
+    assert call.calls == 2
+
+
+def test_slow_calls_open_the_breaker(slow):
+    call = FlakyCall(slow, slow, slow)
+    with pytest.raises(bot.GeminiUnavailable):
+        asyncio.run(bot.run_gemini(call, model="model"))
+    assert call.calls == 3
+    assert bot.gemini_breaker.state == "open"
+
+
+def test_stream_that_never_starts_is_retried(slow):
+    call = FlakyCall(slow)
+    assert asyncio.run(collect(bot.stream_gemini(call.stream, model="model"))) == "ok"
+    assert call.calls == 2
+
+
+def test_stream_that_stalls_after_the_first_chunk_is_not_retried(slow):
+    call = FlakyCall(stall=slow)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(collect(bot.stream_gemini(call.stream, model="model")))
+    assert call.calls == 1
+    assert bot.gemini_breaker.failures == 1
@@ -0,0 +1,75 @@
+import asyncio
+
+import bot
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_memory_tier_is_a_bounded_lru():
+    cache = bot.ResponseCache(2, 60)
+    run(cache.put("a", "A"))
+    run(cache.put("b", "B"))
+    assert run(cache.get("a")) == "A"  # a is now the most recently used
+    run(cache.put("c", "C"))
+    assert list(cache.entries) == ["a", "c"]
+    assert run(cache.get("b")) is None
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = bot.ResponseCache(10, 60, clock=clock)
+    run(cache.put("a", "A"))
+    clock.now += 59
+    assert run(cache.get("a")) == "A"
+    clock.now += 1
+    assert run(cache.get("a")) is None
+    assert "a" not in cache.entries
+
+
+def test_hit_and_miss_counters():
+    cache = bot.ResponseCache(10, 60)
+    run(cache.get("a"))
+    run(cache.put("a", "A"))
+    run(cache.get("a"))
+    run(cache.get("a"))
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_disk_tier_outlives_the_process_and_is_promoted(tmp_path):
+    path = str(tmp_path / "responses.sqlite3")
+    run(bot.ResponseCache(10, 60, path).put("a", "A"))
+    cache = bot.ResponseCache(10, 60, path)
+    assert cache.entries == {}
+    assert run(cache.get("a")) == "A"
+    assert list(cache.entries) == ["a"]
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_expired_disk_entries_are_not_returned(tmp_path, clock):
+    path = str(tmp_path / "responses.sqlite3")
+    run(bot.ResponseCache(10, 60, path, clock=clock).put("a", "A"))
+    clock.now += 60
+    assert run(bot.ResponseCache(10, 60, path, clock=clock).get("a")) is None
+
+
+def test_disk_tier_is_pruned_every_few_writes(tmp_path, clock):
+    cache = bot.ResponseCache(100, 60, str(tmp_path / "responses.sqlite3"), disk_size=5, prune_every=4, clock=clock)
+
+    def stored():
+        return sorted(key for key, in cache.db.execute("SELECT key FROM responses"))
+
+    for i in range(7):
+        clock.now += 1
+        run(cache.put(f"k{i}", "text"))
+    # Pruned at the 4th write only; k4 to k6 were added since
+    assert stored() == ["k0", "k1", "k2", "k3", "k4", "k5", "k6"]
+    clock.now += 1
+    run(cache.put("k7", "text"))
+    assert stored() == ["k3", "k4", "k5", "k6", "k7"]
+
+    # Expired answers go first
+    clock.now += 60
+    for i in range(8, 12):
+        run(cache.put(f"k{i}", "text"))
+    assert stored() == ["k10", "k11", "k8", "k9"]
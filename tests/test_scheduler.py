@@ -0,0 +1,141 @@
+import asyncio
+
+import bot
+
+
+def make_scheduler(clock, model_rpm=60, key_rpm=6000, burst=100):
+    return bot.GeminiScheduler(model_rpm=model_rpm, key_rpm=key_rpm, burst=burst, clock=clock, sleep=clock.sleep)
+
+
+# Starts one acquire per request, all queued before the scheduler runs, and
+# returns the labels in the order the requests were let through
+async def grant_order(scheduler, requests):
+    order = []
+
+    async def one(label, lane, guild, user):
+        bot.request_context.set({"command": "test", "lane": lane, "guild": guild, "user": user})
+        await scheduler.acquire("model")
+        order.append(label)
+
+    await asyncio.gather(*(one(*request) for request in requests))
+    return order
+
+
+def test_token_bucket_delay(clock):
+    bucket = bot.TokenBucket(rate=1, burst=2, clock=clock)
+    for _ in range(2):
+        assert bucket.delay() == 0
+        bucket.take()
+    assert bucket.delay() == 1.0
+    clock.now += 0.5
+    assert bucket.delay() == 0.5
+    clock.now += 0.5
+    assert bucket.delay() == 0
+
+
+def test_lanes_are_served_by_priority(clock):
+    scheduler = make_scheduler(clock)
+    order = asyncio.run(grant_order(scheduler, [
+        ("video", 2, 1, 1),
+        ("ask", 0, 1, 2),
+        ("pdf", 1, 1, 3),
+        ("ask again", 0, 1, 4),
+    ]))
+    assert order == ["ask", "ask again", "pdf", "video"]
+
+
+def test_round_robin_across_guilds_then_users(clock):
+    scheduler = make_scheduler(clock)
+    order = asyncio.run(grant_order(scheduler, [
+        ("a1-1", 0, "A", "a1"),
+        ("a1-2", 0, "A", "a1"),
+        ("a1-3", 0, "A", "a1"),
+        ("a2-1", 0, "A", "a2"),
+        ("b1-1", 0, "B", "b1"),
+        ("b1-2", 0, "B", "b1"),
+    ]))
+    assert order == ["a1-1", "b1-1", "a2-1", "b1-2", "a1-2", "a1-3"]
+
+
+def test_calls_wait_for_tokens(clock):
+    scheduler = make_scheduler(clock, model_rpm=60, burst=1)
+    granted = []
+
+    async def main():
+        async def one():
+            await scheduler.acquire("model")
+            granted.append(clock.now)
+
+        await asyncio.gather(*(one() for _ in range(3)))
+
+    asyncio.run(main())
+    assert granted == [0.0, 1.0, 2.0]
+    assert [lane for lane, _ in scheduler.waits] == [0, 0, 0]
+    assert scheduler.wait_percentiles(1.0) == {0: 2.0}
+
+
+def test_cancelled_waiters_are_skipped(clock):
+    scheduler = make_scheduler(clock, model_rpm=60, burst=1)
+    granted = []
+
+    async def main():
+        async def one(label):
+            await scheduler.acquire("model")
+            granted.append((label, clock.now))
+
+        first = asyncio.ensure_future(one("first"))
+        second = asyncio.ensure_future(one("second"))
+        third = asyncio.ensure_future(one("third"))
+        await first
+        second.cancel()
+        await asyncio.gather(second, third, return_exceptions=True)
+
+    asyncio.run(main())
+    # The cancelled call took no token, so the next one goes after one refill
+    assert granted == [("first", 0.0), ("third", 1.0)]
+    assert scheduler.depth() == {}
+
+
+def test_shared_buckets_are_used_off_the_event_loop(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "SHARED_STATE_PATH", str(tmp_path / "shared_state.sqlite3"))
+    scheduler = bot.GeminiScheduler(model_rpm=6000, key_rpm=6000, burst=1)
+    threads = set()
+    delay = bot.SharedTokenBucket.delay
+
+    def record_delay(bucket):
+        threads.add(bot.threading.current_thread().name)
+        return delay(bucket)
+
+    monkeypatch.setattr(bot.SharedTokenBucket, "delay", record_delay)
+
+    async def main():
+        await asyncio.gather(*(scheduler.acquire("model") for _ in range(3)))
+
+    asyncio.run(main())
+    assert threads and all(name.startswith("shared-state") for name in threads)
+    names = {name for name, in scheduler.shared_db.execute("SELECT name FROM buckets")}
+    assert sorted(name.split(":")[0] for name in names) == ["key", "model"]
+
+
+def test_bucket_errors_fail_the_call_not_the_queue(monkeypatch, clock):
+    scheduler = make_scheduler(clock)
+    bucket = scheduler.bucket("model", "model")
+    delay = bucket.delay
+    failures = [bot.sqlite3.OperationalError("database is locked")]
+
+    def flaky_delay():
+        if failures:
+            raise failures.pop()
+        return delay()
+
+    monkeypatch.setattr(bucket, "delay", flaky_delay)
+
+    async def main():
+        first = asyncio.ensure_future(scheduler.acquire("model"))
+        second = asyncio.ensure_future(scheduler.acquire("model"))
+        return await asyncio.gather(first, second, return_exceptions=True)
+
+    first, second = asyncio.run(main())
+    assert isinstance(first, bot.sqlite3.OperationalError)
+    assert second is None
+    assert scheduler.depth() == {}
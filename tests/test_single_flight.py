@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+def test_identical_calls_share_one_result():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def main():
+        flight = bot.SingleFlight()
+        return await asyncio.gather(flight.run("k", call), flight.run("k", call)), flight
+
+    results, flight = asyncio.run(main())
+    assert results == [("answer", True), ("answer", False)]
+    assert (len(calls), flight.shared) == (1, 1)
+
+
+def test_failure_reaches_every_waiter():
+    async def call():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("quota")
+
+    async def main():
+        flight = bot.SingleFlight()
+        results = await asyncio.gather(
+            flight.run("k", call), flight.run("k", call), return_exceptions=True
+        )
+        return results, flight
+
+    results, flight = asyncio.run(main())
+    assert [str(result) for result in results] == ["quota", "quota"]
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flight.calls == {}
+
+
+def test_cancelling_the_first_caller_keeps_the_shared_call():
+    async def call():
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def main():
+        flight = bot.SingleFlight()
+        first = asyncio.create_task(flight.run("k", call))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(flight.run("k", call))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == ("answer", False)
+
+
+def test_ask_rechecks_the_cache_after_sending_the_placeholder(monkeypatch):
+    cache = bot.ResponseCache(10, 60)
+    sent = []
+    key = cache.key("ask", bot.MODEL_ID, "What?")
+
+    async def safe_send(ctx, content):
+        # Another /ask for the same question finishes meanwhile
+        await cache.put(key, "cached answer")
+        return "placeholder"
+
+    async def generate_reply(*args, **kwargs):
+        raise AssertionError("Gemini should not be called")
+
+    async def send_long_message(ctx, prefix, text, placeholder=None):
+        sent.append((text, placeholder))
+
+    monkeypatch.setattr(bot, "response_cache", cache)
+    monkeypatch.setattr(bot, "safe_send", safe_send)
+    monkeypatch.setattr(bot, "generate_reply", generate_reply)
+    monkeypatch.setattr(bot, "send_long_message", send_long_message)
+    asyncio.run(bot.bot.get_command("ask").callback(object(), question="What?"))
+    assert sent == [("cached answer", "placeholder")]
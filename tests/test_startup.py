@@ -0,0 +1,34 @@
+import asyncio
+import threading
+
+import bot
+
+
+def test_warm_up_loads_modules_and_client_off_the_loop(monkeypatch):
+    threads = []
+    real_import = bot.importlib.import_module
+
+    def import_module(name, *args, **kwargs):
+        threads.append(threading.current_thread())
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(bot.importlib, "import_module", import_module)
+    for name in ("genai", "types", "errors", "httpx", "Image", "ImageOps"):
+        monkeypatch.setattr(bot, name, bot.LazyModule(getattr(bot, name)._name))
+    monkeypatch.setattr(bot, "client_gemini", bot.LazyClient())
+
+    async def main():
+        await asyncio.get_running_loop().run_in_executor(None, bot.warm_up)
+
+    asyncio.run(main())
+    assert bot.client_gemini._client is not None
+    assert bot.genai._module is not None and bot.ImageOps._module is not None
+    assert threads and threading.main_thread() not in threads
+
+
+def test_warm_up_failure_leaves_lazy_loading_in_place(monkeypatch):
+    client = bot.LazyClient()
+    monkeypatch.setattr(bot, "client_gemini", client)
+    monkeypatch.setattr(client, "_load", lambda: (_ for _ in ()).throw(ValueError("no key")))
+    bot.warm_up()
+    assert client._client is None
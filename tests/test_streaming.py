@@ -0,0 +1,81 @@
+import asyncio
+import time
+import types
+
+import bot
+
+
+def stream(ctx, text, placeholder=False, chunk_size=100):
+    async def main():
+        message = await ctx.send("Thinking...") if placeholder else None
+        reply = bot.StreamingReply(ctx, "**Response:** ", message, interval=0)
+        for i in range(0, len(text), chunk_size):
+            await reply.feed(text[i:i + chunk_size])
+        await reply.finish()
+        return ctx.sent
+
+    return asyncio.run(main())
+
+
+def paragraphs(count):
+    return "\n\n".join(f"Paragraph {i}: " + "word " * 60 for i in range(count))
+
+
+def test_short_reply_is_streamed_into_messages(fake_context):
+    text = paragraphs(20)
+    sent = stream(fake_context(), text, placeholder=True)
+    assert 1 < len(sent) <= bot.MESSAGE_FILE_THRESHOLD
+    assert all(not message.attachments for message in sent)
+    assert all(len(message.content) <= 2000 for message in sent)
+
+
+def test_long_reply_is_attached_to_one_message(fake_context):
+    text = paragraphs(70)
+    assert len(text) > 20000
+    sent = stream(fake_context(), text, placeholder=True)
+    assert len(sent) == 1
+    assert sent[0].content == f"**Response:** The full response ({len(text)} characters) is attached."
+    [file] = sent[0].attachments
+    assert file.filename == "response.md"
+    assert file.fp.read().decode("utf-8") == text
+
+
+def test_long_reply_without_placeholder(fake_context):
+    text = paragraphs(70)
+    sent = stream(fake_context(), text)
+    assert len(sent) == 1
+    assert sent[0].attachments[0].filename == "response.md"
+
+
+
+def test_first_chunk_is_visible_before_generation_ends(fake_context, monkeypatch):
+    bot.warm_up()  # as after startup, so the timing leaves out the imports
+    def generate_content_stream(*, model, contents, config=None):
+        for _ in range(5):
+            time.sleep(0.1)
+            yield bot.types.GenerateContentResponse(
+                candidates=[{"content": {"role": "model", "parts": [{"text": "Some words. "}]}}],
+            )
+
+    monkeypatch.setattr(bot, "client_gemini", types.SimpleNamespace(
+        models=types.SimpleNamespace(generate_content=None, generate_content_stream=generate_content_stream),
+    ))
+    monkeypatch.setattr(bot, "gemini_scheduler", bot.GeminiScheduler(model_rpm=10**6, key_rpm=10**6, burst=10**6))
+    monkeypatch.setattr(bot, "STREAM_RESPONSES", True)
+    shown = []
+
+    class Context(fake_context):
+        async def send(self, content=None, file=None, **kwargs):
+            shown.append((time.perf_counter(), content))
+            return await super().send(content, file, **kwargs)
+
+    async def main():
+        start = time.perf_counter()
+        text = await bot.generate_reply(Context(), "**Answer:** ", "Question?")
+        return start, time.perf_counter(), text
+
+    start, end, text = asyncio.run(main())
+    assert text == "Some words. " * 5
+    first_at, first = shown[0]
+    assert first.startswith("**Answer:** Some words.")
+    assert first_at - start < 0.3 < end - start
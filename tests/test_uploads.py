@@ -0,0 +1,63 @@
+import asyncio
+import itertools
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def uploads(monkeypatch, tmp_path, inline_gemini):
+    numbers = itertools.count(1)
+    uploaded = []
+
+    def upload_payload(payload):
+        name = f"files/{next(numbers)}"
+        uploaded.append(name)
+        return bot.types.File(name=name, uri=f"https://example.com/{name}", mime_type=payload.mime_type)
+
+    monkeypatch.setattr(bot, "upload_cache", bot.UploadCache(str(tmp_path / "uploads.sqlite3"), 3600))
+    monkeypatch.setattr(bot, "upload_payload", upload_payload)
+    return uploaded
+
+
+def gone(code):
+    return bot.errors.ClientError(code, {"error": {"code": code, "message": "File not found.", "status": "NOT_FOUND"}})
+
+
+def test_cached_upload_is_reused(uploads):
+    payload = bot.AttachmentPayload("a.pdf", "application/pdf", data=b"%PDF-1.4 test")
+    used = []
+
+    async def use(file_upload, digest):
+        used.append(file_upload.name)
+
+    asyncio.run(bot.with_upload(payload, use))
+    asyncio.run(bot.with_upload(payload, use))
+    assert uploads == ["files/1"]
+    assert used == ["files/1", "files/1"]
+
+
+@pytest.mark.parametrize("code", [403, 404])
+def test_missing_cached_upload_is_uploaded_again(uploads, code):
+    payload = bot.AttachmentPayload("a.pdf", "application/pdf", data=b"%PDF-1.4 test")
+    asyncio.run(bot.upload_file(payload))
+
+    async def use(file_upload, digest):
+        if file_upload.name == "files/1":
+            raise gone(code)
+        return file_upload.name
+
+    assert asyncio.run(bot.with_upload(payload, use)) == "files/2"
+    assert asyncio.run(bot.upload_cache.get(asyncio.run(payload.digest()))).name == "files/2"
+
+
+def test_fresh_upload_is_not_retried(uploads):
+    payload = bot.AttachmentPayload("a.pdf", "application/pdf", data=b"%PDF-1.4 test")
+
+    async def use(file_upload, digest):
+        raise gone(404)
+
+    with pytest.raises(bot.errors.ClientError):
+        asyncio.run(bot.with_upload(payload, use))
+    assert uploads == ["files/1"]
@@ -0,0 +1,81 @@
+import asyncio
+import types
+
+import pytest
+
+import bot
+
+
+def test_scene_changes_are_picked_strongest_first():
+    scores = [1.0, 0.1, 0.5, 0.0, 0.9, 0.2, 0.4]
+    assert bot.pick_keyframes(scores, count=3, threshold=0.3) == [0, 2, 4]
+
+
+def test_keyframes_are_filled_with_evenly_spaced_frames():
+    scores = [1.0] + [0.0] * 9
+    assert bot.pick_keyframes(scores, count=4, threshold=0.3) == [0, 3, 6, 9]
+
+
+def test_fill_skips_frames_already_picked_as_scene_changes():
+    scores = [0.0, 0.0, 0.0, 0.8, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    assert bot.pick_keyframes(scores, count=3, threshold=0.3) == [0, 3, 4]
+
+
+def test_short_videos_keep_every_sample():
+    assert bot.pick_keyframes([1.0, 0.0], count=8, threshold=0.3) == [0, 1]
+
+
+@pytest.fixture
+def command(monkeypatch, fake_context):
+    ctx = fake_context(command="describe_video")
+    ctx.interaction = object()
+    submitted = []
+    downloads = []
+
+    async def preflight(attachment, command=None):
+        if attachment.size > 100:
+            raise bot.AttachmentRejected(f"{attachment.filename} is too large.")
+        return "video/mp4", 100
+
+    async def download(url, write, limit):
+        downloads.append(url)
+        write(b"video")
+
+    async def submit(ctx, attachment):
+        submitted.append(attachment)
+        return 1
+
+    async def video_keyframe_contents(payload):
+        return None  # longer than VIDEO_FAST_MAX_SECONDS
+
+    monkeypatch.setattr(bot, "HAVE_CV2", True)
+    monkeypatch.setattr(bot, "preflight", preflight)
+    monkeypatch.setattr(bot, "download", download)
+    monkeypatch.setattr(bot, "video_keyframe_contents", video_keyframe_contents)
+    monkeypatch.setattr(bot.job_queue, "submit", submit)
+
+    def describe_video(size):
+        attachment = types.SimpleNamespace(filename="clip.mp4", content_type="video/mp4", size=size, url="url")
+        asyncio.run(bot.bot.get_command("describe_video").callback(ctx, video=attachment))
+
+    return types.SimpleNamespace(run=describe_video, sent=ctx.sent, submitted=submitted, downloads=downloads)
+
+
+def test_rejected_video_replaces_the_placeholder(command):
+    command.run(size=1000)
+    [placeholder] = command.sent
+    assert placeholder.content.endswith(" clip.mp4 is too large.")
+    assert command.submitted == []
+
+
+def test_long_video_job_reuses_the_download(command):
+    command.run(size=10)
+    [attachment] = command.submitted
+    assert " Video queued as job #1;" in command.sent[0].content
+
+    async def load():
+        async with bot.load_attachment(attachment) as payload:
+            return payload.read()
+
+    assert asyncio.run(load()) == b"video"
+    assert command.downloads == ["url"]